@@ -0,0 +1,102 @@
+"""Report the memory used by each level in a large show.
+
+The levels of a synthetic show of 2,000 cues with 60 levels each are created
+twice: once as FunctionLevel objects, and once as objects with the same
+attributes held in an instance dict, as FunctionLevel was before it was given
+__slots__. The levels are then held in the packed columns used by cues, and
+the same comparison is made for fixture functions.
+
+Run from the root of the repository with:
+    python benchmarks/level_memory.py
+"""
+
+import os
+import random
+import sys
+import tracemalloc
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pylux import document
+
+CUES = 2000
+LEVELS_PER_CUE = 60
+FIXTURES = 5000
+PARAMETERS = ['Dimmer', 'Pan', 'Tilt', 'Zoom', 'Red', 'Green', 'Blue', 'Shutter']
+
+
+class DictLevel:
+    """A level with the same attributes as FunctionLevel, held in a dict."""
+
+    def __init__(self, function, value):
+        level = document.FunctionLevel(function, value)
+        self.function = level.function
+        self._value = level.value
+        self.raw = level.raw
+        self.hex = level.hex
+        self.palette_type = level.palette_type
+        self.palette_ref = level.palette_ref
+        self.palette = None
+        self.palette_token = None
+
+
+class DictFunction:
+    """A fixture function with its attributes held in a dict."""
+
+    def __init__(self, parameter, offset, uuid):
+        self.uuid = uuid
+        self.parameter = parameter
+        self.offset = offset
+
+
+def measure(factory, args):
+    """Return the number of bytes allocated per object to create an object
+    from each of args."""
+    tracemalloc.start()
+    objects = [factory(*a) for a in args]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(objects)
+
+
+def measure_columns(cues):
+    """Return the number of bytes allocated per level to hold each of cues in
+    the columns of a CueLevelMap, including the tables of ordinals which all
+    the cues of a document share."""
+    n = sum(len(c) for c in cues)
+    tracemalloc.start()
+    tables = document.LevelTables()
+    # The maps are kept until after the measurement, so that their columns
+    # are still allocated when it is taken
+    maps = [document.CueLevelMap([document.FunctionLevel(f, v) for f, v in c]) for c in cues]
+    for levels in maps:
+        levels._attach(tables)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del maps
+    return size / n
+
+
+def main():
+    random.seed(0)
+    functions = [str(uuid4()) for i in range(FIXTURES * len(PARAMETERS))]
+    levels = []
+    for i in range(CUES):
+        for function in random.sample(functions, LEVELS_PER_CUE):
+            levels.append((function, random.choice([str(random.randint(0, 255)),
+                                                    'H' + format(random.randint(0, 255), '02X'),
+                                                    'CP' + str(random.randint(1, 20))])))
+    personality = [(param, [n + 1], functions[i * len(PARAMETERS) + n])
+                   for i in range(FIXTURES) for n, param in enumerate(PARAMETERS)]
+    print('Levels:             {0}'.format(len(levels)))
+    print('Bytes per level:    {0:.0f} with a dict, {1:.0f} with slots, {2:.0f} in columns'.format(
+        measure(DictLevel, levels), measure(document.FunctionLevel, levels),
+        measure_columns([levels[i:i + LEVELS_PER_CUE] for i in range(0, len(levels), LEVELS_PER_CUE)])))
+    print('Functions:          {0}'.format(len(personality)))
+    print('Bytes per function: {0:.0f} with a dict, {1:.0f} with slots'.format(
+        measure(DictFunction, personality), measure(document.FixtureFunction, personality)))
+
+
+if __name__ == '__main__':
+    main()
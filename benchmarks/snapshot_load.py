@@ -0,0 +1,88 @@
+"""Compare the time taken to load a large document from JSON and from its
+binary snapshot.
+
+A synthetic document of 5,000 fixtures with eight functions each, patched
+across 80 universes, 20 colour palettes and 2,000 cues of 60 levels each is
+written to a temporary directory, then loaded from each format in turn.
+
+Run from the root of the repository with:
+    python benchmarks/snapshot_load.py
+"""
+
+from decimal import Decimal
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pylux import document
+
+FIXTURES = 5000
+CUES = 2000
+LEVELS_PER_CUE = 60
+PALETTES = 20
+PARAMETERS = ['Dimmer', 'Pan', 'Tilt', 'Zoom', 'Red', 'Green', 'Blue', 'Shutter']
+REPEATS = 3
+
+
+def build_document():
+    random.seed(0)
+    doc = document.Document()
+    functions = []
+    for i in range(1, FIXTURES + 1):
+        fixture = document.Fixture(ref=Decimal(i), label='Fixture ' + str(i))
+        fixture.data['gel'] = 'R' + str(random.randint(1, 99))
+        fixture.data['fixture-type'] = 'Generic'
+        for n, param in enumerate(PARAMETERS):
+            func = document.FixtureFunction(param, [n + 1])
+            fixture.functions.append(func)
+            functions.append(func)
+        doc.insert_object(fixture)
+    for n, fixture in enumerate(list(doc.get_by_type(document.Fixture))):
+        doc.patch_fixture(fixture, n // 64 + 1, (n % 64) * len(PARAMETERS) + 1)
+    for i in range(1, PALETTES + 1):
+        palette = document.ColourPalette(ref=Decimal(i))
+        palette.set_levels({f.uuid: str(random.randint(0, 255)) for f in random.sample(functions, 200)})
+        doc.insert_object(palette)
+    for i in range(1, CUES + 1):
+        cue = document.Cue(ref=Decimal(i), cue_list=1, label='Cue ' + str(i))
+        cue.set_levels({f.uuid: random.choice([str(random.randint(0, 255)),
+                                               'H' + format(random.randint(0, 255), '02X'),
+                                               'CP' + str(random.randint(1, PALETTES))])
+                        for f in random.sample(functions, LEVELS_PER_CUE)})
+        doc.insert_object(cue)
+    return doc
+
+
+def time_load(path):
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        document.Document(load_path=path)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.json')
+        doc = build_document()
+        doc.write_snapshots = True
+        doc.write_file(path)
+        snapshot_path = path + document.SNAPSHOT_SUFFIX
+        print('JSON size:     {0:.1f} MB'.format(os.path.getsize(path) / 1e6))
+        print('Snapshot size: {0:.1f} MB'.format(os.path.getsize(snapshot_path) / 1e6))
+        snapshot_time = time_load(path)
+        os.remove(snapshot_path)
+        json_time = time_load(path)
+        print('JSON load:     {0:.3f} s'.format(json_time))
+        print('Snapshot load: {0:.3f} s'.format(snapshot_time))
+
+
+if __name__ == '__main__':
+    main()
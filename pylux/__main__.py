@@ -21,7 +21,7 @@ import configparser
 import importlib
 import os.path
 import pkg_resources
-from pylux import document, interpreter
+from pylux import document, interpreter, sqlitedocument
 from pylux.lib import data, exception
 
 
@@ -41,17 +41,28 @@ def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-f', '--file', default=config['main']['default-file'])
     arg_parser.add_argument('-i', '--interface', default=config['main']['default-interface'])
+    arg_parser.add_argument('-l', '--lazy', action='store_true')
     args = arg_parser.parse_args()
 
     # If the specified file or autosave file doesn't exist, create a blank
     # document there
     if not os.path.isfile(args.file):
         print('Creating new file at '+args.file)
-        with open(args.file, 'w') as f:
-            f.write('[]')
+        if not sqlitedocument.is_sqlite_path(args.file):
+            with open(args.file, 'w') as f:
+                f.write('[]')
     config['main']['load_file'] = args.file
     print('Opening document at '+args.file)
-    file = document.Document(load_path=args.file)
+    if sqlitedocument.is_sqlite_path(args.file):
+        file = sqlitedocument.SqliteDocument(args.file)
+    else:
+        file = document.Document(load_path=args.file, lazy=args.lazy)
+        file.write_snapshots = config['main'].getboolean('snapshot', fallback=False)
+    if file.dangling_references:
+        print('Could not find {0} objects referred to in the document:'.format(
+            sum(len(i) for i in file.dangling_references.values())))
+        for uuid, dangling in file.dangling_references.items():
+            print('  {0} refers to {1}'.format(file.get_by_uuid(uuid), ', '.join(dangling)))
     print('Initialising command interpreter')
     server = interpreter.Interpreter(file, config)
     for extension in literal_eval(config['interpreter']['default-extensions']):
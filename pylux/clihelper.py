@@ -36,23 +36,17 @@ RefCatch = namedtuple('RefCatch', 'filters')
 RefGroup = namedtuple('RefGroup', 'filters group')
 
 
-def _passes_filter(filt, obj):
-    """Generic function for determining if an object satisfies a filter."""
-    if filt is None:
-        return True
-    if str(obj.get(filt.key)) == str(filt.value):
-        return True
-    else:
-        return False
-
-
-def _passes_all_filters(filter_list, obj):
-    if not filter_list:
-        return True
-    for i in filter_list:
-        if not _passes_filter(i, obj):
-            return False
-    return True
+def _apply_filters(filter_list, objs, doc, obj_type):
+    """Get the objects in objs which satisfy every filter in filter_list. An
+    object satisfies a filter if its value for the key of the filter is the
+    same as the value of the filter, once both are converted to strings.
+    The objects with each value are looked up in the tag index of the
+    document, so each filter is just a set intersection."""
+    for filt in filter_list:
+        if filt is not None:
+            tagged = doc.get_by_tag(obj_type, filt.key, filt.value)
+            objs = [obj for obj in objs if obj.uuid in tagged]
+    return objs
 
 
 def match_objects(user_input, doc=None, obj_type=None, precision=1):
@@ -269,48 +263,41 @@ def match_objects(user_input, doc=None, obj_type=None, precision=1):
             raise exception.ReferenceSyntaxError('Condition could not be interpreted as a number')
 
     # Now we have all the conditions neatly organised in a list, we just
-    # iterate over the object list we got earlier and check which objects
-    # match one of the specified conditions.
+    # need to find the objects which match each of them.
 
     # First of all, if there's a catchall with no filter, we can just return
     # the entire object list straight away and not bother with any of this.
     if RefCatch([]) in conditions:
         return obj_list
 
-    def _is_match(test):
-        """Checks an object against all conditions and returns the index of
-         the condition it matches, if it matches any of them."""
-        ref = Decimal(test.ref)
-        for c in conditions:
-            if type(c) == RefCatch:
-                if _passes_all_filters(c.filters, test):
-                    return conditions.index(c)
-            if type(c) == RefPoint:
-                if _passes_all_filters(c.filters, test) and ref == c.point:
-                    return conditions.index(c)
-            if type(c) == RefRange:
-                if c.max is not None and c.min is not None:
-                    if _passes_all_filters(c.filters, test) and c.min <= ref <= c.max:
-                        return conditions.index(c)
-                elif c.min is not None and c.max is None:
-                    if _passes_all_filters(c.filters, test) and c.min <= ref:
-                        return conditions.index(c)
-                elif c.max is not None and c.min is None:
-                    if _passes_all_filters(c.filters, test) and ref <= c.max:
-                        return conditions.index(c)
-            if type(c) == RefGroup:
-                if _passes_all_filters(c.filters, test) and test in c.group.fixtures:
-                    return conditions.index(c)
-        return False
-
-    matched = [[] for i in range(len(conditions))]
-    for obj in obj_list:
-        pos = _is_match(obj)
-        if pos is not False:
-            matched[pos].append(obj)
-
-    # Flattens nested lists into one ordered list
-    matched = [i for j in matched for i in j]
+    def _get_candidates(c):
+        """Get the objects which could match a condition before its filters
+        are applied. Points and ranges are looked up in the sorted ref index
+        of the document, so objects outside them are never visited."""
+        if type(c) == RefPoint:
+            return doc.get_by_ref_range(obj_type, c.point, c.point)
+        if type(c) == RefRange:
+            return doc.get_by_ref_range(obj_type, c.min, c.max)
+        if type(c) == RefGroup:
+            if not c.group:
+                return []
+            return [fix for fix in c.group.fixtures
+                    if doc.get_by_uuid(fix.uuid) is fix]
+        # A filtered catchall only needs to consider the objects matching
+        # its first filter
+        for filt in c.filters:
+            if filt is not None:
+                return list(doc.get_by_tag(obj_type, filt.key, filt.value).values())
+        return list(obj_list)
+
+    # Each object is only matched once, by the first condition it satisfies
+    matched = []
+    seen = set()
+    for c in conditions:
+        for obj in _apply_filters(c.filters, _get_candidates(c), doc, obj_type):
+            if obj.uuid not in seen:
+                seen.add(obj.uuid)
+                matched.append(obj)
     return matched
 
 
@@ -346,4 +333,4 @@ def resolve_dec_references(user_input):
 
 def refsort(objs):
     """Sort a list of objects by their reference number"""
-    return sorted(objs, key=lambda i: decimal.Decimal(i.ref))
+    return sorted(objs, key=lambda i: i.ref_key)
@@ -1,85 +1,837 @@
-import itertools
-from decimal import Decimal
+from array import array
+import bisect
+from contextlib import contextmanager, nullcontext
+import gc
+from itertools import repeat
+from decimal import Decimal, InvalidOperation
 import json
+import os
+import tempfile
+import weakref
 from typing import List
 from uuid import uuid4
-from pylux.lib import exception
+from pylux.lib import exception, snapshot
 import pylux.lib.keyword as kw
-from copy import deepcopy
+from copy import copy, deepcopy
 
 
 UNLABELLED_STRING = '[Unlabelled]'
 DIMMER_PARAM_NAME = 'Dimmer'
+UNIVERSE_SIZE = 512
+# Number of characters read from a file at a time when streaming
+LOAD_CHUNK_SIZE = 65536
+# Suffix added to the path of a document to give the path of its journal
+JOURNAL_SUFFIX = '.journal'
+# Suffix added to the path of a document to give the path of its snapshot
+SNAPSHOT_SUFFIX = '.snapshot'
+# Kinds of packed level held by a CueLevelMap, stored in the lowest two bits
+LEVEL_RAW = 0
+LEVEL_HEX = 1
+LEVEL_PALETTE = 2
+LEVEL_OTHER = 3
+# Packed values must fit into a signed 32-bit integer after being shifted
+PACKED_LIMIT = 2 ** 29
+# The number of level strings whose packed form is cached
+PACKED_STRINGS_LIMIT = 65536
+# Kinds of change recorded in the change log of a document
+CHANGE_INSERT = 'insert'
+CHANGE_UPDATE = 'update'
+CHANGE_REMOVE = 'remove'
+CHANGE_METADATA = 'metadata'
+# Refs are indexed as integers in thousandths, so that they can be compared
+# without Decimal arithmetic
+REF_SCALE = 1000
+# The number of operations which are kept to be undone
+UNDO_LIMIT = 100
+# The number of changes which are kept in the change log. The log is
+# trimmed back to this once it has grown to twice as many.
+CHANGE_LOG_LIMIT = 10000
+# Stands in for the value of a key which was not in a dict
+_MISSING = object()
 
 
 class Document:
 
-    def __init__(self, load_path=None):
-        self._content = []
-        self.metadata = {}
+    def __init__(self, load_path=None, lazy=False):
+        # Maps the uuid of every object in the document to the object, in
+        # document order. In lazy mode, objects which have not been used yet
+        # are held as their JSON text from the file instead.
+        self._content = {}
+        # Secondary indexes over _content. These must be kept in step with
+        # the content list, so all additions and removals should go through
+        # insert_object and remove_object. Objects held as JSON are not in
+        # these indexes until they are created.
+        self._uuid_index = {}
+        self._type_index = {}
+        self._ref_index = {}
+        # For each type, a sorted list of the refs in use (with repeats
+        # where objects share a ref) and a list of the objects in the same
+        # order, so that ranges of refs can be found by bisection.
+        self._sorted_refs = {}
+        self._sorted_objs = {}
+        # For each type, a sorted list of the distinct whole-number refs in
+        # use, for finding the next free ref.
+        self._whole_refs = {}
+        # The number of batches currently open, and the types whose sorted
+        # indexes are out of date because objects of that type were
+        # inserted or removed during a batch
+        self._batch_depth = 0
+        self._batch_types = set()
+        # The version of the document when the outermost batch began
+        self._batch_version = 0
+        # Inverted indexes of the values objects give for a key, as strings.
+        # They are only built for a type and key the first time objects are
+        # looked up by that key, and are then kept up to date. Maps (type,
+        # key) to a dict of each value and the objects with it, keyed by
+        # uuid. _tag_values holds the indexed value of each object, and
+        # _tag_keys the indexed keys of each type. Objects whose value
+        # changes are added to the end of the dict for their new value, so
+        # the (type, key, value) of any dict which is no longer in the same
+        # order as the type index is kept in _unsorted_tags.
+        self._tag_index = {}
+        self._tag_values = {}
+        self._tag_keys = {}
+        self._unsorted_tags = set()
+        # Maps the uuid of every fixture function in the document to a
+        # tuple of (FixtureFunction, parent Fixture)
+        self._function_index = {}
+        # Maps the uuid of every patched function to a tuple of
+        # (Registry, addresses). Registries in the document update this
+        # themselves as they are patched and unpatched.
+        self._patch_index = {}
+        # Maps the uuid of every fixture in a group to a dict of the groups
+        # it is in, keyed by uuid. Groups keep this up to date themselves
+        # as fixtures are added and removed.
+        self._group_index = {}
+        # Token identifying the current set of palettes. It is replaced
+        # whenever a palette is inserted, removed or renumbered, which
+        # invalidates the palette handles cached on every FunctionLevel.
+        self._palette_token = object()
+        # Indexes of the objects held as JSON in lazy mode, which are used
+        # to find the objects to create when the document is queried: the
+        # uuids of each type, the uuids at each type and ref, and the
+        # uuid of the fixture of each function. The distinct ref keys held
+        # as JSON are also kept per type, sorted when they are next needed
+        # for a range, so that a range only creates the objects inside it
+        self._lazy_types = {}
+        self._lazy_refs = {}
+        self._lazy_functions = {}
+        self._lazy_ref_keys = {}
+        self._lazy_unsorted = set()
+        # Maps cue list to a CueTracker holding the tracked state of the
+        # cues in that list. Trackers are created as they are needed.
+        self._cue_trackers = {}
+        # The ordinals the levels of every cue in the document are packed
+        # with. Cues are repacked with these as they are inserted.
+        self._level_tables = LevelTables()
+        # Objects which have changed since the document was last loaded or
+        # saved, keyed by uuid, with None for objects which were removed
+        self._changes = {}
+        self._metadata_changed = False
+        # The version of the document is increased by every change, and
+        # each change is recorded in the log as a tuple of (version, uuid,
+        # kind). The log only goes back as far as log_start, as it is
+        # cleared whenever a file is loaded and its oldest changes are
+        # dropped once it passes CHANGE_LOG_LIMIT.
+        self.version = 0
+        self._change_log = []
+        self._log_start = 0
+        # Functions to be called with the document after it has changed
+        self._subscribers = []
+        # Operations which can be undone and redone, most recent last. Each
+        # operation is a list of the inverses of the changes it made, in the
+        # order they were made, as tuples of a function and the arguments
+        # to call it with. The inverses of the operation in progress, if
+        # any, are collected in _operation.
+        self._undo_stack = []
+        self._redo_stack = []
+        self._operation = None
+        # Whether changes are being recorded to be undone. This is turned
+        # off while a file is being loaded.
+        self._recording_undo = True
+        # References to objects which were not in the document when the
+        # objects referring to them were loaded, as a dict of the uuid of
+        # each referring object and a list of the uuids it could not find
+        self.dangling_references = {}
+        # The file which the journal of changes is kept against
+        self._journal_base = None
+        self.metadata = DataDict(self)
+        # Whether to write a binary snapshot alongside the file whenever the
+        # whole document is written
+        self.write_snapshots = False
         if load_path:
-            self.load_file(load_path)
-
-    def load_file(self, path):
-        """Load a JSON document from a path."""
-        with open(path, 'r') as f:
-            s = f.read()
-        raw = json.loads(s)
-        for obj in raw:
-            if 'type' not in obj:
-                continue
-            obj_type = obj.pop('type')
-            if obj_type in FILE_NODE_STR_MAP:
-                self._content.append(
-                    FILE_NODE_STR_MAP[obj_type](json_object=obj))
-            elif obj_type == 'metadata':
-                self.metadata = deepcopy(obj['tags'])
-        # Go through and replace all the group lists of fixture UUIDs
-        # with actual Fixture objects
-        for group in self.get_by_type(Group):
-            for n, fix in enumerate(group.fixtures):
-                if type(fix) == str:
-                    group.fixtures[n] = self.get_by_uuid(fix)
+            self.load_file(load_path, lazy=lazy)
+
+    def load_file(self, path, streaming=True, lazy=False):
+        """Load a JSON document from a path. By default the file is streamed,
+        so only one top-level object is decoded at a time. Set streaming to
+        False to parse the whole file in one go. If there is a snapshot of the
+        file which is up to date, it is loaded instead. If the document has a
+        journal, the changes in it are applied as the file is loaded.
+        Set lazy to keep objects in their JSON form until they are first
+        used, so that only the objects needed are ever created. Snapshots
+        are not used in lazy mode."""
+        # Loading allocates a great many objects and none of them are garbage,
+        # so the cyclic garbage collector would only slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        self._recording_undo = False
+        try:
+            with self.batch():
+                self._load_file(path, streaming, lazy)
+        finally:
+            self._recording_undo = True
+            if gc_enabled:
+                gc.enable()
+
+    def _load_file(self, path, streaming, lazy):
+        self.dangling_references = {}
+        journal, journal_metadata = _read_journal(path + JOURNAL_SUFFIX)
+        if lazy:
+            load_json_object = self._add_lazy_object
+        else:
+            load_json_object = self._load_json_object
+        objects = None
+        if not lazy and snapshot.is_current(path + SNAPSHOT_SUFFIX, path):
+            # The whole snapshot is read before anything is inserted, so that
+            # a damaged snapshot can be ignored in favour of the file itself
+            try:
+                objects, metadata = snapshot.read_snapshot(path + SNAPSHOT_SUFFIX)
+                objects = list(objects)
+            except snapshot.SNAPSHOT_ERRORS:
+                objects = None
+        if objects is not None:
+            self.metadata = DataDict(self, metadata)
+            for obj in objects:
+                if obj.uuid in journal:
+                    json_object = journal.pop(obj.uuid)
+                    if json_object is not None:
+                        load_json_object(json_object)
+                else:
+                    self.insert_object(obj)
+        else:
+            with open(path, 'r') as f:
+                if streaming:
+                    raw = _iter_json_list(f, with_text=True)
+                else:
+                    raw = ((obj, None) for obj in json.loads(f.read()))
+                for obj, text in raw:
+                    # Objects which have changed since the file was written are
+                    # taken from the journal instead, keeping their position
+                    if obj.get('uuid') in journal:
+                        obj = journal.pop(obj['uuid'])
+                        text = None
+                        if obj is None:
+                            continue
+                    load_json_object(obj, text)
+        # Anything left in the journal was created since the file was written
+        for obj in journal.values():
+            if obj is not None:
+                load_json_object(obj)
+        if journal_metadata is not None:
+            self.metadata = DataDict(self, journal_metadata)
+        self._resolve_references()
+        self._journal_base = os.path.abspath(path)
+        self._changes = {}
+        self._metadata_changed = False
+        self._change_log = []
+        self._log_start = self.version
+        self._undo_stack = []
+        self._redo_stack = []
+
+    def _load_json_object(self, obj, text=None):
+        """Create and insert an object from its JSON form in the file."""
+        if 'type' not in obj:
+            return
+        obj_type = obj.pop('type')
+        if obj_type in FILE_NODE_STR_MAP:
+            self.insert_object(
+                FILE_NODE_STR_MAP[obj_type](json_object=obj))
+        elif obj_type == 'metadata':
+            self.metadata = DataDict(self, obj['tags'])
+
+    def _add_lazy_object(self, obj, text=None):
+        """Add an object from the file to the document without creating it
+        until it is used. Only the JSON text of the object is kept, which is
+        much smaller than either its decoded form or the object itself."""
+        if obj.get('type') == 'metadata':
+            self.metadata = DataDict(self, obj['tags'])
+            return
+        if obj.get('type') not in FILE_NODE_STR_MAP:
+            return
+        obj_type = FILE_NODE_STR_MAP[obj['type']]
+        self._content[obj['uuid']] = text or json.dumps(obj)
+        self._lazy_types.setdefault(obj_type, {})[obj['uuid']] = None
+        key = to_ref_key(obj['ref'])
+        same_ref = self._lazy_refs.get((obj_type, key))
+        if same_ref is None:
+            same_ref = self._lazy_refs[(obj_type, key)] = []
+            self._lazy_ref_keys.setdefault(obj_type, []).append(key)
+            self._lazy_unsorted.add(obj_type)
+        same_ref.append(obj['uuid'])
+        for func in obj.get('personality', []):
+            self._lazy_functions[func['uuid']] = obj['uuid']
+
+    def _create_lazy_object(self, uuid):
+        """Create an object which is held as JSON, and add it to the
+        indexes, keeping its place in the document."""
+        json_object = json.loads(self._content[uuid])
+        obj_type = FILE_NODE_STR_MAP[json_object.pop('type')]
+        del self._lazy_types[obj_type][uuid]
+        key = to_ref_key(json_object['ref'])
+        same_ref = self._lazy_refs[(obj_type, key)]
+        same_ref.remove(uuid)
+        if not same_ref:
+            del self._lazy_refs[(obj_type, key)]
+            keys = self._lazy_keys(obj_type)
+            i = bisect.bisect_left(keys, key)
+            # The key may already have been taken out by get_by_ref_range
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+        for func in json_object.get('personality', []):
+            self._lazy_functions.pop(func['uuid'], None)
+        obj = obj_type(json_object=json_object)
+        self._content[uuid] = obj
+        self._index_object(obj)
+        self._resolve_object(obj, self.get_by_uuid)
+        if not self._lazy_types[obj_type]:
+            # Objects used before the rest of their type were indexed first,
+            # so put the type index back into document order
+            self._type_index[obj_type] = {
+                uuid: obj for uuid, obj in self._content.items() if type(obj) is obj_type}
+        return obj
+
+    def _resolve_references(self):
+        """Resolve the references between the objects loaded from a file in
+        a single pass once they have all been loaded, as objects may refer
+        to objects after them in the file. Objects still held as JSON
+        resolve their references when they are created."""
+        lookup = self._uuid_index.get
+        for obj in list(self._uuid_index.values()):
+            self._resolve_object(obj, lookup)
+
+    def _resolve_object(self, obj, lookup):
+        """Resolve the references of an object, recording any which could
+        not be found."""
+        dangling = obj.resolve_references(lookup)
+        if dangling:
+            self.dangling_references[obj.uuid] = dangling
+
+    def _lazy_keys(self, obj_type):
+        """Get the sorted ref keys of the objects of a type which are held as
+        JSON."""
+        keys = self._lazy_ref_keys.get(obj_type, [])
+        if obj_type in self._lazy_unsorted:
+            keys.sort()
+            self._lazy_unsorted.discard(obj_type)
+        return keys
+
+    def _create_lazy_type(self, obj_type):
+        """Create all objects of a type which are held as JSON."""
+        lazy = self._lazy_types.get(obj_type)
+        if not lazy:
+            return
+        # Every key is about to go, so don't take them out one at a time
+        self._lazy_ref_keys.pop(obj_type, None)
+        self._lazy_unsorted.discard(obj_type)
+        for uuid in list(lazy):
+            self._create_lazy_object(uuid)
+
+    def _create_all_lazy(self):
+        """Create every object which is held as JSON."""
+        for obj_type in list(self._lazy_types):
+            self._create_lazy_type(obj_type)
 
     def write_file(self, path):
-        """Write a JSON document to a path."""
-        json_document = [i.json() for i in self._content]
-        json_document.append({'type': 'metadata', 'tags': deepcopy(self.metadata)})
-        with open(path, 'w') as f:
-            json.dump(json_document, f)
+        """Write a JSON document to a path. Objects are serialised one at a
+        time into a temporary file alongside the target, which then replaces
+        the target, so a failed write never leaves a partial file behind."""
+        path = os.path.abspath(path)
+
+        def write(f):
+            f.write('[')
+            for obj in self._content.values():
+                # Objects held as JSON have not been used, so have not changed
+                if type(obj) is str:
+                    f.write(obj)
+                else:
+                    json.dump(obj.json(), f)
+                f.write(', ')
+            json.dump({'type': 'metadata', 'tags': self.metadata}, f)
+            f.write(']')
+
+        _write_atomic(path, write)
+        # Everything in the journal is now in the file itself
+        try:
+            os.remove(path + JOURNAL_SUFFIX)
+        except FileNotFoundError:
+            pass
+        if self.write_snapshots:
+            self._create_all_lazy()
+            # The file itself has been written, so a snapshot which can't be
+            # written is only removed, as it no longer matches the file
+            try:
+                snapshot.write_snapshot(self, path + SNAPSHOT_SUFFIX, path)
+            except snapshot.WRITE_ERRORS:
+                try:
+                    os.remove(path + SNAPSHOT_SUFFIX)
+                except FileNotFoundError:
+                    pass
+        self._journal_base = path
+        self._changes = {}
+        self._metadata_changed = False
+
+    def write_journal(self, path):
+        """Save the changes made since the document was last loaded or saved
+        by appending them to the journal of the file at path, which is
+        replayed when the file is next loaded. If the journal is not being
+        kept against this file, the whole document is written instead."""
+        path = os.path.abspath(path)
+        if path != self._journal_base or not os.path.isfile(path):
+            self.write_file(path)
+            return
+        journal_path = path + JOURNAL_SUFFIX
+        with open(journal_path, 'a+') as f:
+            # If a previous save was interrupted part way through a record,
+            # start on a new line so that the next record is still readable
+            if f.tell():
+                f.seek(f.tell() - 1)
+                if f.read(1) != '\n':
+                    f.write('\n')
+            for uuid, obj in self._changes.items():
+                if obj is None:
+                    record = {'op': 'remove', 'uuid': uuid}
+                else:
+                    record = {'op': 'put', 'object': obj.json()}
+                f.write(json.dumps(record) + '\n')
+            if self._metadata_changed:
+                f.write(json.dumps({'op': 'metadata', 'tags': self.metadata}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._changes = {}
+        self._metadata_changed = False
 
     def insert_object(self, obj):
         """Add an object to the internal content list. """
-        self._content.append(obj)
+        self._content[obj.uuid] = obj
+        self._index_object(obj)
+        self._changes[obj.uuid] = obj
+        self._record_change(obj.uuid, CHANGE_INSERT)
+        self._record_undo(self.remove_object, obj)
 
     def remove_object(self, obj):
-        """Remove an object from the internal content list."""
-        self._content.remove(obj)
+        """Remove an object from the internal content list. Fixtures are
+        also removed from every group they are in."""
+        with self.operation():
+            if isinstance(obj, Fixture):
+                for group in self.get_fixture_groups(obj):
+                    group.remove_fixture(obj)
+            del self._content[obj.uuid]
+            self._unindex_object(obj)
+            self._changes[obj.uuid] = None
+            self._record_change(obj.uuid, CHANGE_REMOVE)
+            self._record_undo(self.insert_object, obj)
+
+    def insert_many(self, objs):
+        """Add several objects to the document in a single batch, which is
+        undone as a single operation."""
+        with self.operation(), self.batch():
+            for obj in objs:
+                self.insert_object(obj)
+
+    def remove_many(self, objs):
+        """Remove several objects from the document in a single batch, which
+        is undone as a single operation."""
+        with self.operation(), self.batch():
+            # Inverses are replayed in reverse, so removing the objects from
+            # last to first means undoing puts them back in their order
+            for obj in reversed(list(objs)):
+                self.remove_object(obj)
+
+    @contextmanager
+    def batch(self):
+        """Insert or remove many objects at once. Within a batch, the sorted
+        ref indexes are not kept up to date as objects are inserted and
+        removed, and are instead rebuilt once for each affected type when
+        the batch ends, or when they are next queried. Batches can be
+        nested, in which case the indexes are rebuilt at the end of the
+        outermost batch."""
+        if not self._batch_depth:
+            self._batch_version = self.version
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                for obj_type in list(self._batch_types):
+                    self._sort_type(obj_type)
+                if self._batch_version != self.version:
+                    self._notify()
+
+    @contextmanager
+    def operation(self):
+        """Make all the changes made within the block into a single
+        operation, which is undone and redone as a whole. Changes made
+        outside an operation are each an operation of their own. Operations
+        can be nested, in which case they are all part of the outermost
+        operation."""
+        if self._operation is not None:
+            yield self
+            return
+        self._operation = []
+        try:
+            yield self
+        finally:
+            operation, self._operation = self._operation, None
+            if operation:
+                self._undo_stack.append(operation)
+                del self._undo_stack[:-UNDO_LIMIT]
+                self._redo_stack = []
+
+    def _record_undo(self, undo, *args):
+        """Record the inverse of a change to the document, as a function
+        which undoes the change and the arguments to call it with."""
+        if not self._recording_undo:
+            return
+        if self._operation is None:
+            with self.operation():
+                self._operation.append((undo, args))
+        else:
+            self._operation.append((undo, args))
+
+    def undo(self):
+        """Undo the last operation. Objects which are put back into the
+        document by undoing their removal are added to the end of it, in
+        the order they were in. Return whether there was an operation to
+        undo."""
+        if not self._undo_stack:
+            return False
+        self._redo_stack.append(self._replay(self._undo_stack.pop()))
+        return True
+
+    def redo(self):
+        """Redo the last operation to be undone. Return whether there was
+        an operation to redo."""
+        if not self._redo_stack:
+            return False
+        self._undo_stack.append(self._replay(self._redo_stack.pop()))
+        return True
+
+    def _replay(self, inverses):
+        """Apply the inverses of an operation in reverse order, returning
+        the inverses of the changes they make, which redo the operation."""
+        outer = self._operation
+        self._operation = []
+        try:
+            with self.batch():
+                for undo, args in reversed(inverses):
+                    undo(*args)
+            return self._operation
+        finally:
+            self._operation = outer
+
+    def _sort_type(self, obj_type):
+        """Rebuild the sorted ref indexes of a type from its objects."""
+        self._batch_types.discard(obj_type)
+        objs = sorted((obj for obj in self._type_index.get(obj_type, {}).values() if obj.ref_key is not None),
+                      key=lambda obj: obj.ref_key)
+        self._sorted_objs[obj_type] = objs
+        self._sorted_refs[obj_type] = [obj.ref_key for obj in objs]
+        self._whole_refs[obj_type] = sorted({key // REF_SCALE for key in self._sorted_refs[obj_type]
+                                             if not key % REF_SCALE})
+
+    def _object_changed(self, obj):
+        """Record that an object in the document has been modified."""
+        if self._uuid_index.get(obj.uuid) is obj:
+            self._changes[obj.uuid] = obj
+            self._index_tags(obj)
+            self._record_change(obj.uuid, CHANGE_UPDATE)
+
+    def _data_changing(self, data, k, old):
+        """Called by the metadata dictionary before a key is modified, with
+        the value it had."""
+        self._record_undo(_restore_item, data, k, old)
+
+    def _data_changed(self):
+        """Called by the metadata dictionary whenever it is modified."""
+        self._metadata_changed = True
+        self._record_change(None, CHANGE_METADATA)
+
+    def _record_change(self, uuid, kind):
+        """Add a change to the change log and tell subscribers about it.
+        Within a batch, subscribers are only told once the batch ends."""
+        self.version += 1
+        self._change_log.append((self.version, uuid, kind))
+        # Subscribers are only told about a batch at its end, so a batch
+        # is never trimmed from the log before then
+        if not self._batch_depth and len(self._change_log) >= 2 * CHANGE_LOG_LIMIT:
+            dropped = len(self._change_log) - CHANGE_LOG_LIMIT
+            del self._change_log[:dropped]
+            self._log_start += dropped
+        if not self._batch_depth:
+            self._notify()
+
+    def _notify(self):
+        for callback in list(self._subscribers):
+            callback(self)
+
+    def subscribe(self, callback):
+        """Call callback with the document whenever it changes. Callbacks
+        can then use changes_since to find out what has changed."""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling a callback when the document changes."""
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def changes_since(self, version: int):
+        """Get the objects which have changed since a version of the
+        document, as a dict of uuids and the kind of change, which is one of
+        CHANGE_INSERT, CHANGE_UPDATE or CHANGE_REMOVE. Changes to the
+        metadata are given under a uuid of None, with a kind of
+        CHANGE_METADATA. Objects which were inserted and then removed again
+        are left out. Returns None if the version is from before the
+        document was last loaded or from before the oldest change still in
+        the log, in which case anything may have changed."""
+        if version < self._log_start:
+            return None
+        changes = {}
+        # Every change increases the version by one, so the log holds the
+        # change to each version from log_start onwards in turn
+        for v, uuid, kind in self._change_log[version - self._log_start:]:
+            previous = changes.get(uuid)
+            if kind == CHANGE_REMOVE and previous == CHANGE_INSERT:
+                del changes[uuid]
+            elif kind == CHANGE_INSERT and previous == CHANGE_REMOVE:
+                changes[uuid] = CHANGE_UPDATE
+            elif kind != CHANGE_UPDATE or previous is None:
+                changes[uuid] = kind
+        return changes
+
+    def _index_object(self, obj):
+        """Add an object to the uuid, type and reference indexes."""
+        obj._document = self
+        self._uuid_index[obj.uuid] = obj
+        self._type_index.setdefault(type(obj), {})[obj.uuid] = obj
+        self._index_tags(obj)
+        self._index_ref(obj)
+        if isinstance(obj, Fixture):
+            for func in obj.functions:
+                self._function_index[func.uuid] = (func, obj)
+        if isinstance(obj, Registry):
+            for pe in obj.entries:
+                self._index_patch(obj, pe)
+        if isinstance(obj, Group):
+            for uuid in obj.fixtures.uuids():
+                self._group_fixture_changed(obj, uuid, True)
+        if isinstance(obj, Palette):
+            self._palette_token = object()
+        if isinstance(obj, Cue):
+            # Trackers changed during a batch are rebuilt when next needed
+            if self._batch_depth:
+                self._cue_trackers.pop(obj.get('cue_list'), None)
+            elif obj.get('cue_list') in self._cue_trackers:
+                self._cue_trackers[obj.get('cue_list')].insert(obj)
+
+    def _unindex_object(self, obj):
+        """Remove an object from the uuid, type and reference indexes."""
+        obj._document = None
+        if self._uuid_index.get(obj.uuid) is obj:
+            del self._uuid_index[obj.uuid]
+        self._type_index.get(type(obj), {}).pop(obj.uuid, None)
+        self._unindex_tags(obj)
+        self._unindex_ref(obj, obj.ref_key)
+        if isinstance(obj, Fixture):
+            for func in obj.functions:
+                if self._function_index.get(func.uuid, (None, None))[1] is obj:
+                    del self._function_index[func.uuid]
+        if isinstance(obj, Registry):
+            for pe in obj.entries:
+                self._unindex_patch(obj, pe)
+        if isinstance(obj, Group):
+            for uuid in obj.fixtures.uuids():
+                self._group_fixture_changed(obj, uuid, False)
+        if isinstance(obj, Palette):
+            self._palette_token = object()
+        if isinstance(obj, Cue):
+            # Trackers changed during a batch are rebuilt when next needed
+            if self._batch_depth:
+                self._cue_trackers.pop(obj.get('cue_list'), None)
+            elif obj.get('cue_list') in self._cue_trackers:
+                self._cue_trackers[obj.get('cue_list')].remove(obj)
+
+    def _index_ref(self, obj):
+        """Add an object to the reference indexes under its ref key."""
+        key = obj.ref_key
+        same_ref = self._ref_index.setdefault((type(obj), key), [])
+        same_ref.append(obj)
+        if self._batch_depth:
+            self._batch_types.add(type(obj))
+        elif key is not None:
+            refs = self._sorted_refs.setdefault(type(obj), [])
+            i = bisect.bisect_right(refs, key)
+            refs.insert(i, key)
+            self._sorted_objs.setdefault(type(obj), []).insert(i, obj)
+            if len(same_ref) == 1 and not key % REF_SCALE:
+                whole_refs = self._whole_refs.setdefault(type(obj), [])
+                bisect.insort(whole_refs, key // REF_SCALE)
+
+    def _unindex_ref(self, obj, key):
+        """Remove an object from the reference indexes, in which it is held
+        under the given ref key."""
+        same_ref = self._ref_index.get((type(obj), key), [])
+        indexed = obj in same_ref
+        if indexed:
+            same_ref.remove(obj)
+        if self._batch_depth:
+            self._batch_types.add(type(obj))
+        elif indexed and key is not None:
+            refs = self._sorted_refs[type(obj)]
+            objs = self._sorted_objs[type(obj)]
+            i = bisect.bisect_left(refs, key)
+            while objs[i] is not obj:
+                i += 1
+            del refs[i]
+            del objs[i]
+            if not same_ref and not key % REF_SCALE:
+                whole_refs = self._whole_refs[type(obj)]
+                del whole_refs[bisect.bisect_left(whole_refs, key // REF_SCALE)]
+        if not same_ref:
+            self._ref_index.pop((type(obj), key), None)
+
+    def _ref_changed(self, obj, old_key):
+        """Move an object in the reference indexes after its ref has been
+        changed."""
+        self._unindex_ref(obj, old_key)
+        self._index_ref(obj)
+        if isinstance(obj, Palette):
+            self._palette_token = object()
+
+    def _index_tags(self, obj):
+        """Add an object to the tag indexes of its type, or move it to the
+        right place in them if its values have changed."""
+        for key in self._tag_keys.get(type(obj), []):
+            values = self._tag_values[(type(obj), key)]
+            value = str(obj.get(key))
+            old_value = values.get(obj.uuid)
+            if old_value == value:
+                continue
+            index = self._tag_index[(type(obj), key)]
+            if old_value is not None:
+                del index[old_value][obj.uuid]
+                if not index[old_value]:
+                    del index[old_value]
+                if value in index:
+                    self._unsorted_tags.add((type(obj), key, value))
+            index.setdefault(value, {})[obj.uuid] = obj
+            values[obj.uuid] = value
+
+    def _unindex_tags(self, obj):
+        """Remove an object from the tag indexes of its type."""
+        for key in self._tag_keys.get(type(obj), []):
+            old_value = self._tag_values[(type(obj), key)].pop(obj.uuid, None)
+            if old_value is not None:
+                index = self._tag_index[(type(obj), key)]
+                del index[old_value][obj.uuid]
+                if not index[old_value]:
+                    del index[old_value]
+
+    def _index_patch(self, reg: 'Registry', pe: 'PatchEntry'):
+        """Record a patch entry of a registry in the patch index."""
+        self._patch_index[pe.function] = (reg, pe.addresses)
+        self._object_changed(reg)
+
+    def _unindex_patch(self, reg: 'Registry', pe: 'PatchEntry'):
+        """Remove a patch entry of a registry from the patch index."""
+        if self._patch_index.get(pe.function, (None, None))[0] is reg:
+            del self._patch_index[pe.function]
+        self._object_changed(reg)
+
+    def _group_fixture_changed(self, group: 'Group', uuid, added):
+        """Record that a fixture has been added to or removed from a group
+        in the group index."""
+        if added:
+            self._group_index.setdefault(uuid, {})[group.uuid] = group
+        else:
+            groups = self._group_index.get(uuid, {})
+            if groups.get(group.uuid) is group:
+                del groups[group.uuid]
+                if not groups:
+                    del self._group_index[uuid]
+
+    def get_fixture_groups(self, fixture: 'Fixture'):
+        """Get a list of the groups a fixture is in."""
+        self._create_lazy_type(Group)
+        return list(self._group_index.get(fixture.uuid, {}).values())
 
     def get_by_type(self, obj_type):
         """Get an iterator of all objects of a given type."""
-        for obj in self._content:
-            if type(obj) == obj_type:
-                yield obj
+        self._create_lazy_type(obj_type)
+        # Iterate over a copy so that callers can safely insert or remove
+        # objects while consuming the iterator
+        yield from list(self._type_index.get(obj_type, {}).values())
 
     def get_by_ref(self, obj_type, ref: Decimal):
         """Get the object of a given type with a given reference."""
-        for obj in self.get_by_type(obj_type):
-            if obj.ref == Decimal(ref):
-                return obj
+        key = to_ref_key(ref)
+        for uuid in list(self._lazy_refs.get((obj_type, key), [])):
+            self._create_lazy_object(uuid)
+        same_ref = self._ref_index.get((obj_type, key))
+        if same_ref:
+            return same_ref[0]
+
+    def get_by_ref_range(self, obj_type, r_min: Decimal = None, r_max: Decimal = None):
+        """Get a list of all objects of a given type with references between
+        r_min and r_max inclusive, in reference order. Leave either bound
+        as None for an open range."""
+        if self._lazy_types.get(obj_type):
+            self._create_lazy_range(obj_type, r_min, r_max)
+        if obj_type in self._batch_types:
+            self._sort_type(obj_type)
+        refs = self._sorted_refs.get(obj_type, [])
+        start = 0 if r_min is None else bisect.bisect_left(refs, to_ref_key(r_min))
+        end = len(refs) if r_max is None else bisect.bisect_right(refs, to_ref_key(r_max))
+        return self._sorted_objs.get(obj_type, [])[start:end]
+
+    def _create_lazy_range(self, obj_type, r_min, r_max):
+        """Create the objects of a type held as JSON whose references are
+        between r_min and r_max inclusive."""
+        keys = self._lazy_keys(obj_type)
+        start = 0 if r_min is None else bisect.bisect_left(keys, to_ref_key(r_min))
+        end = len(keys) if r_max is None else bisect.bisect_right(keys, to_ref_key(r_max))
+        in_range = keys[start:end]
+        del keys[start:end]
+        for key in in_range:
+            for uuid in list(self._lazy_refs.get((obj_type, key), [])):
+                self._create_lazy_object(uuid)
 
     def next_ref(self, obj_type):
         """Get the next available whole-number reference for an object type."""
-        used = [obj.ref for obj in self.get_by_type(obj_type)]
-        for i in itertools.count(start=1):
-            if Decimal(i) not in used:
-                return Decimal(i)
+        self._create_lazy_type(obj_type)
+        if obj_type in self._batch_types:
+            self._sort_type(obj_type)
+        whole_refs = self._whole_refs.get(obj_type, [])
+        # Find the first ref below which there is a gap. Only refs from 1
+        # upwards are considered, so every ref before the gap is equal to
+        # its position plus one.
+        lo = bisect.bisect_left(whole_refs, 1)
+        offset = lo - 1
+        hi = len(whole_refs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if whole_refs[mid] == mid - offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return Decimal(lo - offset)
 
     def get_by_uuid(self, uuid):
         """Get the object with the given unique identifier."""
-        for obj in self._content:
-            if obj.uuid == uuid:
-                return obj
+        if type(self._content.get(uuid)) is str:
+            return self._create_lazy_object(uuid)
+        return self._uuid_index.get(uuid)
 
     def duplicate_object(self, src: 'TopLevelObject', dest_ref: Decimal):
         """Duplicate a source object with a new reference."""
@@ -88,33 +840,51 @@ class Document:
             raise exception.ObjectAlreadyExistsError(obj_type, dest_ref)
         new_obj = src.get_copy()
         new_obj.ref = dest_ref
-        self._content.append(new_obj)
+        self.insert_object(new_obj)
 
     def get_function_by_uuid(self, uuid: str):
         """Get a function object given its unique identifier."""
-        for fix in self.get_by_type(Fixture):
-            for func in fix.functions:
-                if func.uuid == uuid:
-                    return func
+        if uuid in self._lazy_functions:
+            self._create_lazy_object(self._lazy_functions[uuid])
+        return self._function_index.get(uuid, (None, None))[0]
 
     def get_function_parent(self, func: 'FixtureFunction'):
         """Get the fixture that a function belongs to."""
-        for fix in self.get_by_type(Fixture):
-            for func_i in fix.functions:
-                if func.uuid == func_i.uuid:
-                    return fix
+        if func.uuid in self._lazy_functions:
+            self._create_lazy_object(self._lazy_functions[func.uuid])
+        return self._function_index.get(func.uuid, (None, None))[1]
+
+    def add_function(self, fixture: 'Fixture', func: 'FixtureFunction'):
+        """Append a function to the personality of a fixture. Functions
+        of fixtures which are already in the document should be added
+        this way so that the function index stays up to date."""
+        fixture.functions.append(func)
+        if self._uuid_index.get(fixture.uuid) is fixture:
+            self._function_index[func.uuid] = (func, fixture)
+            self._object_changed(fixture)
+            self._record_undo(self._remove_function, fixture, func)
+
+    def _remove_function(self, fixture: 'Fixture', func: 'FixtureFunction'):
+        """Remove a function from the personality of a fixture. This is
+        only used to undo add_function."""
+        fixture.functions.remove(func)
+        if self._uuid_index.get(fixture.uuid) is fixture:
+            self._function_index.pop(func.uuid, None)
+            self._object_changed(fixture)
+            self._record_undo(self.add_function, fixture, func)
 
     def get_function_patch(self, func: 'FixtureFunction'):
         """Get the registry and address number of a functions patch."""
-        for reg in self.get_by_type(Registry):
-            addr = reg.get_function_patch(func)
-            if addr:
-                return reg, addr
+        self._create_lazy_type(Registry)
+        return self._patch_index.get(func.uuid)
 
     def unpatch_fixture_from_all(self, fixture: 'Fixture'):
         """Unpatch a fixture from all registries."""
-        for reg in self.get_by_type(Registry):
-            reg.unpatch_fixture(fixture)
+        self._create_lazy_type(Registry)
+        for func in fixture.functions:
+            patch = self._patch_index.get(func.uuid)
+            if patch:
+                patch[0].unpatch_function(func)
 
     def patch_fixture(self, fixture: 'Fixture', universe: int, address: int):
         """Patch a fixture to a universe and address, automatically creating
@@ -125,40 +895,285 @@ class Document:
             reg = self.get_by_ref(Registry, Decimal(universe))
         reg.patch_fixture(fixture, address)
 
+    def get_tracked_levels(self, cue: 'Cue'):
+        """Get the tracked state of a cue, as a dict of function uuids and
+        tuples of (FunctionLevel, Cue) for the level of each function and
+        the cue it was last set in."""
+        cue_list = cue.get('cue_list')
+        if cue_list not in self._cue_trackers:
+            self._cue_trackers[cue_list] = CueTracker(
+                self.filter_type_by_params(Cue, [('cue_list', cue_list)]))
+        return self._cue_trackers[cue_list].get_state(cue)
+
+    def _cue_levels_changed(self, cue: 'Cue'):
+        """Invalidate any tracked state which depends on the levels of a
+        cue."""
+        tracker = self._cue_trackers.get(cue.get('cue_list'))
+        if tracker:
+            tracker.invalidate(cue)
+
+    def _cue_order_changed(self):
+        """Discard all tracked state, after the ref or cue list of a cue
+        has changed."""
+        self._cue_trackers = {}
+
     def get_raw_cue_level(self, cue: 'Cue', function: 'FixtureFunction'):
         """Get the raw level of a function in a cue, taking into account
         hex encoding and palette references."""
-        level = cue.function_level(function)
+        level = cue.levels.get(function.uuid)
         if level is None:
             return None
-        try:
-            return int(level)
-        except ValueError:
-            pass
-        if level[0] == 'H':
-            try:
-                return int(level.split('H')[1], 16)
-            except ValueError:
-                pass
-        if level[0:2] in PALETTE_PREFIXES:
-            palette_type = PALETTE_PREFIXES[level[0:2]]
-            palette = self.get_by_ref(palette_type, Decimal(level[2:]))
-            raw = int(palette.get_function_level(function))
-            if raw is not None:
-                return raw
+        return self.get_raw_level(level, function)
+
+    def get_raw_level(self, level: 'FunctionLevel', function: 'FixtureFunction'):
+        """Get the raw value of a level of a function, following it into
+        the referenced palette if necessary."""
+        if level.raw is not None:
+            return level.raw
+        palette = self.resolve_palette(level)
+        if palette:
+            palette_level = palette.levels.get(function.uuid)
+            if palette_level:
+                return palette_level.raw
+
+    def resolve_palette(self, level: 'FunctionLevel'):
+        """Get the palette a level refers to, if any. The palette is cached
+        on the level until palettes are next inserted into, removed from or
+        renumbered in the document."""
+        if not level.palette_type:
+            return None
+        if level.palette_token is not self._palette_token:
+            level.palette = self.get_by_ref(level.palette_type, level.palette_ref)
+            level.palette_token = self._palette_token
+        return level.palette
+
+    def get_by_tag(self, obj_type, key, value):
+        """Get the objects of a type whose value for a key, as given by
+        their get method, is the same as value once both are converted to
+        strings. Returns a dict of the objects keyed by uuid, which must not
+        be modified. The first lookup of a key for a type builds an index of
+        it, which makes later lookups of the same key immediate."""
+        if (obj_type, key) not in self._tag_index:
+            self._tag_index[(obj_type, key)] = {}
+            self._tag_values[(obj_type, key)] = {}
+            self._tag_keys.setdefault(obj_type, []).append(key)
+            self._create_lazy_type(obj_type)
+            for obj in self._type_index.get(obj_type, {}).values():
+                self._index_tags(obj)
+        index = self._tag_index[(obj_type, key)]
+        value = str(value)
+        if (obj_type, key, value) in self._unsorted_tags:
+            self._unsorted_tags.discard((obj_type, key, value))
+            if value in index:
+                tagged = index[value]
+                index[value] = {uuid: obj for uuid, obj in self._type_index[obj_type].items() if uuid in tagged}
+        return index.get(value, {})
 
     def filter_type_by_params(self, obj_type, params):
         """Get all objects which satisfy the parameters given by key/value
         pairs in params"""
-        matches = []
-        for obj in self.get_by_type(obj_type):
-            match = True
-            for param in params:
-                if obj.get(param[0]) != param[1]:
-                    match = False
-            if match:
-                matches.append(obj)
-        return matches
+        if not params:
+            return list(self.get_by_type(obj_type))
+        candidates = self.get_by_tag(obj_type, params[0][0], params[0][1]).values()
+        return [obj for obj in candidates if all(obj.get(k) == v for k, v in params)]
+
+
+def to_ref_key(ref):
+    """Convert a ref to the integer key it is indexed by, which is the ref in
+    thousandths. Refs may be given as Decimals, ints or strings, and any
+    finer than a thousandth are rounded to the nearest thousandth. None is
+    returned unchanged."""
+    if ref is None:
+        return None
+    if type(ref) == int:
+        return ref * REF_SCALE
+    return int((Decimal(ref) * REF_SCALE).to_integral_value())
+
+
+def _iter_json_list(f, chunk_size=LOAD_CHUNK_SIZE, with_text=False):
+    """Iterate over the items of a JSON list in a file, decoding one item at
+    a time from chunks of the file so that the whole text never needs to be
+    held in memory. Set with_text to get tuples of each item and its text."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+
+    def skip(chars):
+        nonlocal buffer, pos, eof
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            buffer = f.read(chunk_size)
+            pos = 0
+            eof = not buffer
+
+    while True:
+        skip(' \t\r\n,' if started else ' \t\r\n')
+        if pos >= len(buffer):
+            raise json.JSONDecodeError('Unexpected end of file', buffer, pos)
+        if not started:
+            if buffer[pos] != '[':
+                raise json.JSONDecodeError('Expecting a list', buffer, pos)
+            pos += 1
+            started = True
+            continue
+        if buffer[pos] == ']':
+            return
+        # Keep reading until a complete item has been decoded. An item is only
+        # accepted once a separator follows it, so that a number cut off at
+        # the end of a chunk is not mistaken for a complete one.
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                if eof or (end < len(buffer) and buffer[end] in ' \t\r\n,]'):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+        if with_text:
+            text = buffer[pos:end]
+            pos = end
+            yield item, text
+        else:
+            pos = end
+            yield item
+
+
+def _write_atomic(path, write):
+    """Write a file by calling write with a temporary file alongside path,
+    which then replaces path once it is safely on disk."""
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable only by its owner, so give it
+        # the permissions of the file it replaces, or the default ones
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _read_journal(path):
+    """Read the journal at path, if there is one. Returns a dict of the
+    uuids of every object changed in the journal and either the JSON form of
+    the object or None if it was removed, and the metadata if it changed."""
+    objects = {}
+    metadata = None
+    if not os.path.isfile(path):
+        return objects, metadata
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A record which was only partly written when a save was
+                # interrupted. Anything it contained was never saved.
+                continue
+            if record['op'] == 'put':
+                objects.pop(record['object']['uuid'], None)
+                objects[record['object']['uuid']] = record['object']
+            elif record['op'] == 'remove':
+                objects.pop(record['uuid'], None)
+                objects[record['uuid']] = None
+            elif record['op'] == 'metadata':
+                metadata = record['tags']
+    return objects, metadata
+
+
+class DataDict(dict):
+    """A dictionary which tells its owner whenever it is modified, by
+    calling the _data_changed method of the owner. Before a key is
+    modified, the _data_changing method of the owner is called with the
+    dictionary, the key and its old value, or _MISSING if it was not set,
+    so that the change can be undone."""
+
+    def __init__(self, owner, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner = owner
+
+    def _changing(self, k, old):
+        owner = getattr(self, 'owner', None)
+        if owner is not None:
+            owner._data_changing(self, k, old)
+
+    def _changed(self):
+        # The owner may not have been set yet while the dict is being copied
+        owner = getattr(self, 'owner', None)
+        if owner is not None:
+            owner._data_changed()
+
+    def __setitem__(self, k, v):
+        self._changing(k, self.get(k, _MISSING))
+        super().__setitem__(k, v)
+        self._changed()
+
+    def __delitem__(self, k):
+        self._changing(k, self.get(k, _MISSING))
+        super().__delitem__(k)
+        self._changed()
+
+    def pop(self, k, *args):
+        self._changing(k, self.get(k, _MISSING))
+        v = super().pop(k, *args)
+        self._changed()
+        return v
+
+    def popitem(self):
+        item = super().popitem()
+        self._changing(*item)
+        self._changed()
+        return item
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self._changing(k, _MISSING)
+        v = super().setdefault(k, default)
+        self._changed()
+        return v
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        for k in items:
+            self._changing(k, self.get(k, _MISSING))
+        super().update(items)
+        self._changed()
+
+    def clear(self):
+        for k, v in self.items():
+            self._changing(k, v)
+        super().clear()
+        self._changed()
+
+
+def _restore_item(data: DataDict, k, old):
+    """Put back the old value of a key in a data dictionary, which is
+    _MISSING if the key was not set."""
+    if old is _MISSING:
+        data.pop(k, None)
+    else:
+        data[k] = old
 
 
 class TopLevelObject:
@@ -178,6 +1193,13 @@ class TopLevelObject:
     # be defined separately.
     required_attributes = []
 
+    # The document the object has been inserted into, if any. This is set
+    # and cleared by the document itself and is never copied or written
+    # to file.
+    _document = None
+    # The integer key of the ref, which is kept in step with it
+    _ref_key = None
+
     def __init__(self, uuid: str = None, ref: Decimal = None,
                  label: str = None, json_object: dict = None, **kwargs):
         """
@@ -204,6 +1226,37 @@ class TopLevelObject:
         if json_object:
             self._read_json(json_object)
 
+    def __setattr__(self, key, value):
+        document = None if key.startswith('_') else self._document
+        old_ref_key = self._ref_key
+        if document:
+            document._record_undo(setattr, self, key, self.__dict__.get(key))
+        if key == 'ref':
+            super().__setattr__('_ref_key', to_ref_key(value))
+        super().__setattr__(key, value)
+        if document:
+            if self._ref_key != old_ref_key:
+                document._ref_changed(self, old_ref_key)
+            document._object_changed(self)
+
+    @property
+    def ref_key(self):
+        """The ref as an integer, for indexing and comparing refs without
+        Decimal arithmetic. See to_ref_key."""
+        return self._ref_key
+
+    def _data_changing(self, data, k, old):
+        """Called by the data dictionary of the object before a key is
+        modified, with the value it had."""
+        if self._document:
+            self._document._record_undo(_restore_item, data, k, old)
+
+    def _data_changed(self):
+        """Called by the data dictionary or levels of the object whenever
+        they are modified."""
+        if self._document:
+            self._document._object_changed(self)
+
     def _read_json(self, json_object):
         """
         Fill the object data using information from a JSON object. Call
@@ -245,13 +1298,35 @@ class TopLevelObject:
     def __str__(self):
         return ' '.join([self.noun, str(self.ref)])
 
+    def __getstate__(self):
+        # Never carry the owning document into a copy of the object
+        state = self.__dict__.copy()
+        state.pop('_document', None)
+        return state
+
     def get_copy(self):
         """Return a copy of this object, with changes to features which
-        are required to stay unique."""
-        new_instance = deepcopy(self)
+        are required to stay unique. The copy shares as much as it can with
+        this object, so copying is cheap however large the object is."""
+        new_instance = copy(self)
+        new_instance._copy_from(self)
         new_instance.uuid = str(uuid4())
         return new_instance
 
+    def _copy_from(self, other: 'TopLevelObject'):
+        """Called on a shallow copy of another object to give it its own
+        version of any attributes which can't be shared. Subclasses with
+        mutable attributes should extend this."""
+        pass
+
+    def resolve_references(self, lookup) -> List[str]:
+        """Replace the uuids of other objects, as they are stored in the
+        file, with the objects themselves. lookup is called with each uuid
+        and returns the object, or None if it is not in the document.
+        Return a list of the uuids which could not be found. Subclasses
+        which refer to other objects should override this."""
+        return []
+
     def get(self, k):
         """Get the value of a key, if it is a required attribute, otherwise
         return None."""
@@ -267,11 +1342,18 @@ class ArbitraryDataObject(TopLevelObject):
 
     def __init__(self, data: dict = None, *args, **kwargs):
         if not data:
-            self.data = {}
+            self.data = DataDict(self)
         else:
-            self.data = data
+            self.data = DataDict(self, data)
         super().__init__(*args, **kwargs)
 
+    def _copy_from(self, other):
+        super()._copy_from(other)
+        # Tag values are almost always strings, so only containers need to
+        # be copied
+        self.data = DataDict(self, {k: deepcopy(v) if isinstance(v, (list, dict)) else v
+                                    for k, v in other.data.items()})
+
     def _read_json(self, json_object):
         super()._read_json(json_object)
         for k, v in json_object.items():
@@ -304,10 +1386,7 @@ class Cue(ArbitraryDataObject):
     required_attributes = ['cue_list']
 
     def __init__(self, levels: List['FunctionLevel'] = None, *args, **kwargs):
-        if not levels:
-            self.levels = []
-        else:
-            self.levels = levels
+        self.levels = CueLevelMap(levels, self)
         super().__init__(*args, **kwargs)
         # In addition to the normal ref, which is just a Decimal and not
         # necessarily unique, a cue will have a canonical ref which should
@@ -318,19 +1397,36 @@ class Cue(ArbitraryDataObject):
         else:
             self.canonical_ref = '1/' + str(self.ref)
 
+    def __setattr__(self, key, value):
+        super().__setattr__(key, value)
+        # Moving a cue changes the order of cues used for tracking
+        if key in ('ref', 'cue_list') and self._document:
+            self._document._cue_order_changed()
+        # The levels of every cue in a document are packed with its tables
+        if key == '_document' and value is not None:
+            self.levels._attach(value._level_tables)
+
+    def _copy_from(self, other):
+        super()._copy_from(other)
+        self.levels = other.levels.share(self)
+        if self._document:
+            self.levels._attach(self._document._level_tables)
+
     def _read_json(self, json_object):
         super()._read_json(json_object)
-        for func, val in json_object['levels'].items():
-            self.levels.append(FunctionLevel(func, val))
+        self.levels.merge_levels(json_object['levels'])
 
     def json(self):
         json_object = super().json()
-        levels = {}
-        for l in self.levels:
-            levels[l.function] = l.value
-        json_object['levels'] = levels
+        json_object['levels'] = dict(self.levels.items())
         return json_object
 
+    def levels_changed(self):
+        """Called by the LevelMap of this cue whenever it is modified."""
+        if self._document:
+            self._document._cue_levels_changed(self)
+            self._document._object_changed(self)
+
     def get_text_widget(self):
         if self.get('cue_list') == 1 or not self.get('cue_list'):
             cue_list_str = ''
@@ -345,17 +1441,636 @@ class Cue(ArbitraryDataObject):
 
     def function_level(self, function: 'FixtureFunction'):
         """Get the value of a function in this cue if applicable."""
-        for level in self.levels:
-            if level.function == function.uuid:
-                return level.value
+        level = self.levels.get(function.uuid)
+        if level:
+            return level.value
+
+    def set_levels(self, levels: dict):
+        """Replace all levels in this cue with a dict of function uuids
+        and their values."""
+        self.levels.set_levels(levels)
+
+    def merge_levels(self, levels: dict):
+        """Add or update levels in this cue from a dict of function uuids
+        and their values, leaving all other levels as they are."""
+        self.levels.merge_levels(levels)
 
 
 class FunctionLevel:
 
+    # Levels are by far the most numerous objects in a document, so are kept
+    # without an instance dict
+    __slots__ = ('function', '_value', 'raw', 'hex', 'palette_type', 'palette_ref', 'palette', 'palette_token')
+
     def __init__(self, function: str = None, value: str = None):
         self.function = function
         self.value = value
 
+    @classmethod
+    def from_parsed(cls, function: str, value: str, raw: int = None, hex: bool = False,
+                    palette_type: type = None, palette_ref: Decimal = None):
+        """Create a level from a value which has already been parsed, for
+        example by a previous run of the program, without parsing it again.
+        The parsed fields must be the same as those the value would give."""
+        level = cls.__new__(cls)
+        level.function = function
+        level._value = value
+        level.raw = raw
+        level.hex = hex
+        level.palette_type = palette_type
+        level.palette_ref = palette_ref
+        level.palette = None
+        level.palette_token = None
+        return level
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        """Set the level as it is stored in the file and parse it, so that
+        the raw value or palette reference does not need to be worked out
+        again each time it is used."""
+        self._value = value
+        # The raw DMX value, for plain decimal and H-prefixed hex levels
+        self.raw = None
+        self.hex = False
+        # The type and reference of the palette, for referenced levels
+        self.palette_type = None
+        self.palette_ref = None
+        # The resolved palette, cached by Document.resolve_palette
+        self.palette = None
+        self.palette_token = None
+        if value is None:
+            return
+        try:
+            self.raw = int(value)
+            return
+        except ValueError:
+            pass
+        value = str(value)
+        if value[0:1] == 'H':
+            try:
+                self.raw = int(value[1:], 16)
+                self.hex = True
+                return
+            except ValueError:
+                pass
+        if value[0:2] in PALETTE_PREFIXES:
+            try:
+                self.palette_ref = Decimal(value[2:])
+                self.palette_type = PALETTE_PREFIXES[value[0:2]]
+            except InvalidOperation:
+                pass
+
+    def __getstate__(self):
+        # The cached palette belongs to the document, so is never copied
+        state = {k: getattr(self, k) for k in self.__slots__}
+        state['palette'] = None
+        state['palette_token'] = None
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+class MapLevel(FunctionLevel):
+    """A level given by a LevelMap, which belongs to the map. Setting the
+    value of a MapLevel changes the level through the map it came from, so
+    that the change is recorded like any other change to the map."""
+
+    __slots__ = ('_levels', '__weakref__')
+
+    @FunctionLevel.value.setter
+    def value(self, value):
+        levels = getattr(self, '_levels', None)
+        if levels is None:
+            FunctionLevel.value.fset(self, value)
+        else:
+            levels.merge_levels({self.function: value})
+
+    def __reduce__(self):
+        # Copies are plain FunctionLevels, which don't belong to any map
+        return FunctionLevel.from_parsed, (self.function, self._value, self.raw, self.hex,
+                                           self.palette_type, self.palette_ref)
+
+
+class LevelMap:
+    """The levels of a cue or palette, keyed by the uuid of the function
+    each level applies to. Iterating over a LevelMap gives its
+    FunctionLevels in the order their functions were first added. The
+    levels given by a LevelMap are its own, so setting the value of one
+    changes the level in the map, and the same level is given each time
+    it is asked for."""
+
+    # Whether the levels may be held by another LevelMap as well, in which
+    # case they are copied before they are first modified or given out
+    _shared = False
+    # Whether levels have been given out, in which case they may be held
+    # elsewhere and changed through, so are never shared with a copy
+    _given_out = False
+
+    def __init__(self, levels: List['FunctionLevel'] = None, owner=None):
+        self._levels = {}
+        # The object these levels belong to. If it has a levels_changed
+        # method, it is called after every modification.
+        self.owner = owner
+        if levels:
+            for level in levels:
+                self._levels[level.function] = self._own(level)
+
+    def __iter__(self):
+        # Levels which are still shared are copied before they are given
+        # out, as they may be changed through the level itself
+        self._unshare()
+        self._given_out = True
+        return iter(self._levels.values())
+
+    def __len__(self):
+        return len(self._levels)
+
+    def __contains__(self, function_uuid):
+        return function_uuid in self._levels
+
+    def get(self, function_uuid: str):
+        """Get the FunctionLevel of a function, if it has one."""
+        self._unshare()
+        level = self._levels.get(function_uuid)
+        if level is not None:
+            self._given_out = True
+        return level
+
+    def _value(self, function_uuid):
+        """Get the value of the level of a function, or None if it has no
+        level, without giving the level out."""
+        level = self._levels.get(function_uuid)
+        return level.value if level else None
+
+    def items(self):
+        """Get an iterator of the function uuid and value of each level, for
+        reading the levels without needing the levels themselves."""
+        for function_uuid, level in self._levels.items():
+            yield function_uuid, level.value
+
+    def share(self, owner=None):
+        """Return a LevelMap with the same levels as this one, which are
+        only copied once either of them is modified. If levels have already
+        been given out by this map, they may be changed at any time through
+        the levels themselves, so the copy is given levels of its own
+        straight away."""
+        shared = copy(self)
+        shared.owner = owner
+        shared._given_out = False
+        if self._given_out:
+            shared._levels = {f: shared._own(level) for f, level in self._levels.items()}
+            shared._shared = False
+        else:
+            shared._shared = self._shared = True
+        return shared
+
+    def _unshare(self):
+        if self._shared:
+            self._levels = {f: self._own(level) for f, level in self._levels.items()}
+            self._shared = False
+
+    def _own(self, level):
+        """Get a level belonging to this map with the same value as a given
+        level, which is the level itself if it does not belong to a map."""
+        if type(level) is not MapLevel or getattr(level, '_levels', None) is not None:
+            level = MapLevel.from_parsed(level.function, level._value, level.raw, level.hex,
+                                         level.palette_type, level.palette_ref)
+        level._levels = self
+        return level
+
+    def _detach(self, levels):
+        for level in levels:
+            level._levels = None
+
+    def append(self, level: 'FunctionLevel'):
+        """Add a level, replacing any existing level for the same function.
+        The level added is the given level if it does not already belong to
+        a map, otherwise a copy of it."""
+        self._changing([level.function])
+        self._unshare()
+        old = self._levels.get(level.function)
+        if old is not None:
+            self._detach([old])
+        self._levels[level.function] = self._own(level)
+        self._changed()
+
+    def remove(self, level: 'FunctionLevel'):
+        """Remove the level of a function."""
+        self.pop(level.function)
+
+    def pop(self, function_uuid: str):
+        """Remove and return the level of a function, if it has one."""
+        self._changing([function_uuid])
+        self._unshare()
+        level = self._levels.pop(function_uuid, None)
+        if level is not None:
+            self._detach([level])
+        self._changed()
+        return level
+
+    def set_levels(self, levels: dict):
+        """Replace all levels with a dict of function uuids and values."""
+        self._changing(list(self._levels) + list(levels))
+        # Shared levels belong to the map they were copied from
+        if not self._shared:
+            self._detach(self._levels.values())
+        self._levels = {}
+        self._shared = False
+        self._merge(levels)
+        self._changed()
+
+    def merge_levels(self, levels: dict):
+        """Add or update levels from a dict of function uuids and
+        values."""
+        self._changing(levels)
+        self._merge(levels)
+        self._changed()
+
+    def _merge(self, levels: dict):
+        self._unshare()
+        for function_uuid, value in levels.items():
+            level = self._levels.get(function_uuid)
+            if level:
+                FunctionLevel.value.fset(level, value)
+            else:
+                level = self._levels[function_uuid] = MapLevel(function_uuid, value)
+                level._levels = self
+
+    def _changing(self, function_uuids):
+        # Levels only need to be put back if they belong to an object in a
+        # document, which records the old values to undo the change
+        document = getattr(self.owner, '_document', None)
+        if document is not None and function_uuids:
+            old = {function_uuid: self._value(function_uuid) for function_uuid in function_uuids}
+            document._record_undo(_restore_levels, self, old)
+
+    def _changed(self):
+        if hasattr(self.owner, 'levels_changed'):
+            self.owner.levels_changed()
+
+
+# The packed form of level strings which pack into DMX values or palette
+# references, as the same few hundred strings make up almost every level in
+# a document. These codes are the same in every document, so the cache is
+# shared, and it is cleared whenever it grows past PACKED_STRINGS_LIMIT.
+_packed_strings = {}
+
+
+def _intern(value, values, ordinals):
+    n = ordinals.get(value)
+    if n is None:
+        n = ordinals[value] = len(values)
+        values.append(value)
+    return n
+
+
+class LevelTables:
+    """The ordinals used by CueLevelMaps to pack their levels. Every
+    function uuid is given an ordinal, as is every level value which cannot
+    be packed into an integer. Each document has its own tables, which are
+    shared by the cues in it, and a cue which is not in a document has
+    tables of its own until it is inserted into one."""
+
+    def __init__(self):
+        self.function_uuids = []
+        self.function_ordinals = {}
+        self.other_values = []
+        self.other_ordinals = {}
+
+    def function_ordinal(self, function_uuid):
+        """Get the ordinal of a function uuid, giving it one if needed."""
+        return _intern(function_uuid, self.function_uuids, self.function_ordinals)
+
+    def function_ordinals_of(self, function_uuids):
+        """Get a list of the ordinals of distinct function uuids, giving
+        them ordinals if needed."""
+        ordinals = self.function_ordinals
+        new = [f for f in function_uuids if f not in ordinals]
+        if new:
+            ordinals.update(zip(new, range(len(self.function_uuids), len(self.function_uuids) + len(new))))
+            self.function_uuids.extend(new)
+        return list(map(ordinals.__getitem__, function_uuids))
+
+    def pack(self, value):
+        """Pack a level value into an integer. The lowest two bits give the
+        kind of level, and the rest give the DMX value, the palette ref and
+        type, or the ordinal of the value. Only values which are unpacked to
+        exactly the same string are packed as DMX values or palette
+        references."""
+        if type(value) is str:
+            code = _packed_strings.get(value)
+            if code is not None:
+                return code
+            if value not in self.other_ordinals:
+                code = _pack_string(value)
+                if code is not None:
+                    if len(_packed_strings) >= PACKED_STRINGS_LIMIT:
+                        _packed_strings.clear()
+                    _packed_strings[value] = code
+                    return code
+        return self.pack_other(value)
+
+    def pack_all(self, values):
+        """Pack a list of level values, as pack does."""
+        try:
+            codes = list(map(_packed_strings.get, values))
+        except TypeError:
+            # Values which can't be hashed are never in the cache
+            codes = [None] * len(values)
+        if None in codes:
+            codes = [self.pack(v) if code is None else code for v, code in zip(values, codes)]
+        return codes
+
+    def pack_other(self, value):
+        """Pack a level value by its ordinal."""
+        return _intern(value, self.other_values, self.other_ordinals) << 2 | LEVEL_OTHER
+
+    def unpack_value(self, code):
+        """Get the level value of a packed value."""
+        kind = code & 3
+        n = code >> 2
+        if kind == LEVEL_RAW:
+            return str(n)
+        elif kind == LEVEL_HEX:
+            return 'H%02X' % n
+        elif kind == LEVEL_PALETTE:
+            ref, i = divmod(n, 8)
+            return PALETTE_TYPES[i].palette_prefix + str(ref)
+        return self.other_values[n]
+
+    def unpack(self, function_uuid, code, cls=None):
+        """Create the FunctionLevel of a function from a packed value, as an
+        instance of cls if it is given."""
+        cls = cls or FunctionLevel
+        kind = code & 3
+        n = code >> 2
+        if kind == LEVEL_RAW:
+            return cls.from_parsed(function_uuid, str(n), n)
+        elif kind == LEVEL_HEX:
+            return cls.from_parsed(function_uuid, 'H%02X' % n, n, True)
+        elif kind == LEVEL_PALETTE:
+            ref, i = divmod(n, 8)
+            palette_type = PALETTE_TYPES[i]
+            return cls.from_parsed(function_uuid, palette_type.palette_prefix + str(ref),
+                                   palette_type=palette_type, palette_ref=Decimal(ref))
+        else:
+            level = cls.from_parsed(function_uuid, None)
+            FunctionLevel.value.fset(level, self.other_values[n])
+            return level
+
+
+def _pack_string(value):
+    """Pack a level string into an integer if it is a DMX value or palette
+    reference, otherwise return None."""
+    try:
+        if value[0:1] == 'H':
+            raw = int(value[1:], 16)
+            if -PACKED_LIMIT <= raw < PACKED_LIMIT and value == 'H%02X' % raw:
+                return raw << 2 | LEVEL_HEX
+        elif value[0:2] in PALETTE_PREFIXES:
+            ref = int(value[2:])
+            if 0 <= ref < PACKED_LIMIT // 8 and value[2:] == str(ref):
+                return (ref * 8 + PALETTE_TYPES.index(PALETTE_PREFIXES[value[0:2]])) << 2 | LEVEL_PALETTE
+        else:
+            raw = int(value)
+            if -PACKED_LIMIT <= raw < PACKED_LIMIT and value == str(raw):
+                return raw << 2 | LEVEL_RAW
+    except ValueError:
+        pass
+    return None
+
+
+class _LevelRef(weakref.ref):
+    """A weak reference to a MapLevel, which knows the function of the
+    level so that it can be forgotten once the level is gone."""
+
+    __slots__ = ('function',)
+
+
+def _forget_level(map_ref):
+    """Make the callback which forgets the levels of a map as they go."""
+    def forget(ref):
+        levels = map_ref()
+        if levels is not None and levels._unpacked and levels._unpacked.get(ref.function) is ref:
+            del levels._unpacked[ref.function]
+    return forget
+
+
+class CueLevelMap(LevelMap):
+    """A LevelMap which holds its levels in two columns rather than as
+    FunctionLevels, as cues hold far more levels than anything else. Each
+    level takes up eight bytes: the ordinal of its function and its packed
+    value. Levels are only created from the columns when they are asked
+    for, as MapLevels. The map keeps a weak reference to each level it has
+    given out, so the same level is given each time while it is still in
+    use, without keeping every level of the cue once it is not."""
+
+    # The tables the levels are packed with
+    _tables = None
+    # The position of each function ordinal in the columns, which is built
+    # when it is first needed and kept until functions are removed
+    _positions = None
+    # Weak references to the MapLevels given out which are still in use,
+    # keyed by function uuid, and the callback which removes them
+    _unpacked = None
+    _forget = None
+
+    def __init__(self, levels: List['FunctionLevel'] = None, owner=None):
+        self._functions = array('I')
+        self._values = array('i')
+        self.owner = owner
+        if levels:
+            self._merge({level.function: level.value for level in levels})
+
+    def __iter__(self):
+        if not self._functions:
+            return
+        function_uuids = self._tables.function_uuids
+        for n, code in zip(self._functions, self._values):
+            yield self._level(function_uuids[n], code)
+
+    def __len__(self):
+        return len(self._functions)
+
+    def __contains__(self, function_uuid):
+        return self._position(function_uuid) is not None
+
+    def items(self):
+        # Values are unpacked straight from the columns, without creating
+        # any levels
+        if not self._functions:
+            return
+        function_uuids = self._tables.function_uuids
+        unpack_value = self._tables.unpack_value
+        for n, code in zip(self._functions, self._values):
+            yield function_uuids[n], unpack_value(code)
+
+    def _position(self, function_uuid):
+        if self._tables is None:
+            return None
+        n = self._tables.function_ordinals.get(function_uuid)
+        if n is None:
+            return None
+        if self._positions is None:
+            self._positions = {n: i for i, n in enumerate(self._functions)}
+        return self._positions.get(n)
+
+    def _level(self, function_uuid, code):
+        """Get the MapLevel of a function with a packed value, which is
+        created if it is not still in use from an earlier call."""
+        unpacked = self._unpacked
+        if unpacked is None:
+            unpacked = self._unpacked = {}
+            # The map is only referred to weakly by its references to its
+            # levels, so that it never has to wait for the cyclic garbage
+            # collector
+            self._forget = _forget_level(weakref.ref(self))
+        ref = unpacked.get(function_uuid)
+        level = ref() if ref is not None else None
+        if level is None:
+            level = self._tables.unpack(function_uuid, code, MapLevel)
+            level._levels = self
+            ref = unpacked[function_uuid] = _LevelRef(level, self._forget)
+            ref.function = function_uuid
+        return level
+
+    def _cached(self, function_uuid):
+        """Get the MapLevel of a function if it is still in use."""
+        ref = self._unpacked.get(function_uuid) if self._unpacked else None
+        return ref() if ref is not None else None
+
+    def _attach(self, tables: 'LevelTables'):
+        """Repack the levels with the tables of the document the map has
+        been added to, so that every cue in a document shares one set of
+        ordinals."""
+        old = self._tables
+        self._tables = tables
+        if old is None or old is tables or not self._functions:
+            return
+        functions = tables.function_ordinals_of(old.function_uuids)
+        self._functions = array('I', [functions[n] for n in self._functions])
+        if old.other_values:
+            others = [tables.pack_other(v) for v in old.other_values]
+            self._values = array('i', [others[code >> 2] if code & 3 == LEVEL_OTHER else code
+                                       for code in self._values])
+        else:
+            self._values = self._values[:]
+        # The columns are new, so are no longer shared with another map
+        self._positions = None
+        self._shared = False
+
+    def share(self, owner=None):
+        shared = super().share(owner)
+        # Levels which have been given out belong to this map only
+        shared._unpacked = None
+        shared._forget = None
+        return shared
+
+    def _unshare(self):
+        if self._shared:
+            self._functions = self._functions[:]
+            self._values = self._values[:]
+            if self._positions is not None:
+                self._positions = dict(self._positions)
+            self._shared = False
+
+    def _merge(self, levels: dict):
+        if self._tables is None:
+            # A map with no tables yet is not in a document, so its levels
+            # are given tables of their own in one go until it is inserted
+            tables = self._tables = LevelTables()
+            tables.function_uuids = list(levels)
+            tables.function_ordinals = dict(zip(levels, range(len(levels))))
+            self._functions = array('I', range(len(levels)))
+            self._values = array('i', tables.pack_all(list(levels.values())))
+            self._positions = None
+            self._shared = False
+            return
+        tables = self._tables
+        if not self._functions:
+            self._functions = array('I', tables.function_ordinals_of(list(levels)))
+            self._values = array('i', tables.pack_all(list(levels.values())))
+            self._positions = None
+            self._shared = False
+            return
+        self._unshare()
+        if self._positions is None:
+            self._positions = {n: i for i, n in enumerate(self._functions)}
+        positions = self._positions
+        for function_uuid, value in levels.items():
+            n = tables.function_ordinal(function_uuid)
+            i = positions.get(n)
+            if i is None:
+                positions[n] = len(self._functions)
+                self._functions.append(n)
+                self._values.append(tables.pack(value))
+            else:
+                self._values[i] = tables.pack(value)
+                level = self._cached(function_uuid)
+                if level is not None:
+                    FunctionLevel.value.fset(level, value)
+
+    def get(self, function_uuid: str):
+        i = self._position(function_uuid)
+        if i is not None:
+            return self._level(function_uuid, self._values[i])
+
+    def _value(self, function_uuid):
+        i = self._position(function_uuid)
+        if i is not None:
+            return self._tables.unpack_value(self._values[i])
+
+    def append(self, level: 'FunctionLevel'):
+        self._changing([level.function])
+        self._merge({level.function: level.value})
+        self._changed()
+
+    def pop(self, function_uuid: str):
+        self._changing([function_uuid])
+        i = self._position(function_uuid)
+        level = None
+        if i is not None:
+            level = self._level(function_uuid, self._values[i])
+            del self._unpacked[function_uuid]
+            self._detach([level])
+            self._unshare()
+            del self._functions[i]
+            del self._values[i]
+            # Every function after the removed one has moved
+            self._positions = None
+        self._changed()
+        return level
+
+    def set_levels(self, levels: dict):
+        function_uuids = self._tables.function_uuids if self._functions else []
+        self._changing([function_uuids[n] for n in self._functions] + list(levels))
+        self._functions = array('I')
+        self._values = array('i')
+        self._positions = None
+        if self._unpacked:
+            self._detach([level for level in (ref() for ref in self._unpacked.values()) if level is not None])
+        self._unpacked = None
+        self._shared = False
+        self._merge(levels)
+        self._changed()
+
+
+def _restore_levels(levels: LevelMap, old: dict):
+    """Put back the old values of levels, given as a dict of function uuids
+    and values, with None for functions which had no level."""
+    merged = {f: v for f, v in old.items() if v is not None}
+    if merged:
+        levels.merge_levels(merged)
+    for function_uuid, value in old.items():
+        if value is None:
+            levels.pop(function_uuid)
+
 
 class CueList:
 
@@ -363,6 +2078,87 @@ class CueList:
         self.ref = ref
 
 
+class CueTracker:
+    """The tracked state of the cues in a single cue list. State is built up
+    in cue order, and a snapshot of it is kept every snapshot_interval cues,
+    so finding the state of a cue only needs the levels of the cues since
+    the last snapshot. Changing a cue invalidates the snapshots after it."""
+
+    snapshot_interval = 16
+
+    def __init__(self, cues: List['Cue']):
+        self._cues = sorted(cues, key=lambda c: c.ref_key)
+        self._refs = [c.ref_key for c in self._cues]
+        # Snapshot n is the tracked state after all cues before position
+        # n * snapshot_interval have been applied
+        self._snapshots = [{}]
+
+    def _position(self, cue: 'Cue'):
+        i = bisect.bisect_left(self._refs, cue.ref_key)
+        while i < len(self._cues) and self._refs[i] == cue.ref_key:
+            if self._cues[i] is cue:
+                return i
+            i += 1
+        return None
+
+    def _apply(self, state, start, end):
+        """Apply the levels of the cues in positions start to end. The state
+        is kept as function ordinals and packed values, straight from the
+        columns of each cue."""
+        for cue in self._cues[start:end]:
+            state.update(zip(cue.levels._functions, zip(cue.levels._values, repeat(cue))))
+
+    def get_state(self, cue: 'Cue'):
+        """Get the tracked state of a cue, as a dict of function uuids and
+        tuples of (FunctionLevel, Cue)."""
+        state = self._get_packed_state(cue)
+        if state is None:
+            return {level.function: (level, cue) for level in cue.levels}
+        # Every cue in the tracker is in the same document, so shares its
+        # tables
+        function_uuids = cue.levels._tables.function_uuids if state else None
+        return {function_uuids[n]: (c.levels._level(function_uuids[n], code), c)
+                for n, (code, c) in state.items()}
+
+    def _get_packed_state(self, cue: 'Cue'):
+        i = self._position(cue)
+        if i is None:
+            return None
+        n = i // self.snapshot_interval
+        while len(self._snapshots) <= n:
+            k = len(self._snapshots)
+            state = dict(self._snapshots[-1])
+            self._apply(state, (k - 1) * self.snapshot_interval, k * self.snapshot_interval)
+            self._snapshots.append(state)
+        state = dict(self._snapshots[n])
+        self._apply(state, n * self.snapshot_interval, i + 1)
+        return state
+
+    def invalidate(self, cue: 'Cue'):
+        """Discard the snapshots which include the given cue."""
+        i = self._position(cue)
+        if i is not None:
+            self._invalidate_from(i)
+
+    def _invalidate_from(self, i):
+        del self._snapshots[i // self.snapshot_interval + 1:]
+
+    def insert(self, cue: 'Cue'):
+        """Add a cue to the cue list."""
+        i = bisect.bisect_right(self._refs, cue.ref_key)
+        self._cues.insert(i, cue)
+        self._refs.insert(i, cue.ref_key)
+        self._invalidate_from(i)
+
+    def remove(self, cue: 'Cue'):
+        """Remove a cue from the cue list."""
+        i = self._position(cue)
+        if i is not None:
+            del self._cues[i]
+            del self._refs[i]
+            self._invalidate_from(i)
+
+
 class Filter(TopLevelObject):
 
     file_node_str = 'filter'
@@ -422,12 +2218,11 @@ class Fixture(ArbitraryDataObject):
             return [('fixture', str(self.ref)), ' ', fixture_type, ' - ',
                     self.label]
 
-    def get_copy(self):
-        new_instance = deepcopy(self)
-        new_instance.uuid = str(uuid4())
-        for func in new_instance.functions:
-            func.uuid = str(uuid4())
-        return new_instance
+    def _copy_from(self, other):
+        super()._copy_from(other)
+        # Functions are given new uuids as they are copied
+        self.functions = [FixtureFunction(func.parameter, func.offset and list(func.offset))
+                          for func in other.functions]
 
     def get_dimmer_function(self):
         """Return the function, if any, that corresponds to the dimmer."""
@@ -452,6 +2247,8 @@ class Fixture(ArbitraryDataObject):
 
 class FixtureFunction:
 
+    __slots__ = ('uuid', 'parameter', 'offset')
+
     def __init__(self, parameter: str = None, offset: List[int] = None, uuid=None):
         """
         A single parameter of a fixture. This should be representative
@@ -486,26 +2283,126 @@ class FixtureFunction:
             return [('function', 'X'), ' ', self.parameter]
 
 
+class FixtureSet:
+    """The fixtures of a group, in the order they were added. Fixtures are
+    keyed by uuid, so a fixture can only be in the set once, and checking
+    whether a fixture is in the set or removing it does not need a search.
+    Until the set has been resolved, fixtures may be held as their uuids,
+    as they are stored in the file."""
+
+    def __init__(self, fixtures=None, owner=None):
+        self._fixtures = {}
+        # The order key of each fixture, which increases with each fixture
+        # added. A fixture put back with its old key goes to the end of the
+        # dict, so the set is then sorted by key when it is next read.
+        self._keys = {}
+        self._next_key = 0
+        self._unsorted = False
+        # The object these fixtures belong to. If it has a fixtures_changed
+        # method, it is called with the fixture, whether it was added and
+        # its order key after every modification.
+        self.owner = owner
+        if fixtures:
+            for fix in fixtures:
+                uuid = fix if type(fix) == str else fix.uuid
+                if uuid not in self._fixtures:
+                    self._fixtures[uuid] = fix
+                    self._keys[uuid] = self._next_key
+                    self._next_key += 1
+
+    def _sort(self):
+        if self._unsorted:
+            keys = self._keys
+            self._fixtures = {uuid: self._fixtures[uuid] for uuid in sorted(self._fixtures, key=keys.get)}
+            self._unsorted = False
+
+    def __iter__(self):
+        self._sort()
+        return iter(self._fixtures.values())
+
+    def __len__(self):
+        return len(self._fixtures)
+
+    def __contains__(self, fixture):
+        return (fixture if type(fixture) == str else fixture.uuid) in self._fixtures
+
+    def uuids(self):
+        """Get the uuids of the fixtures, in order."""
+        self._sort()
+        return list(self._fixtures)
+
+    def append(self, fixture: 'Fixture'):
+        """Add a fixture to the end of the set, if it is not already in it.
+        Return whether it was added."""
+        if fixture.uuid in self._fixtures:
+            return False
+        self._add(fixture, self._next_key)
+        return True
+
+    def insert(self, key: int, fixture: 'Fixture'):
+        """Put a fixture back in the set with the order key it had when it
+        was removed, if it is not already in the set. Return whether it was
+        added."""
+        if fixture.uuid in self._fixtures:
+            return False
+        self._add(fixture, key)
+        return True
+
+    def _add(self, fixture, key):
+        self._fixtures[fixture.uuid] = fixture
+        self._keys[fixture.uuid] = key
+        if key < self._next_key:
+            self._unsorted = True
+        else:
+            self._next_key = key + 1
+        self._changed(fixture, True, key)
+
+    def remove(self, fixture: 'Fixture'):
+        """Remove a fixture from the set, if it is in it. Return whether it
+        was removed."""
+        if fixture.uuid not in self._fixtures:
+            return False
+        del self._fixtures[fixture.uuid]
+        self._changed(fixture, False, self._keys.pop(fixture.uuid))
+        return True
+
+    def resolve(self, lookup):
+        """Replace the uuids of fixtures with the fixtures themselves, using
+        lookup to find each one. Fixtures which can't be found are left out
+        of the set, and their uuids are returned."""
+        dangling = []
+        for uuid, fix in list(self._fixtures.items()):
+            if type(fix) == str:
+                fix = lookup(uuid)
+                if fix is None:
+                    del self._fixtures[uuid]
+                    del self._keys[uuid]
+                    dangling.append(uuid)
+                else:
+                    self._fixtures[uuid] = fix
+        return dangling
+
+    def _changed(self, fixture, added, key):
+        if hasattr(self.owner, 'fixtures_changed'):
+            self.owner.fixtures_changed(fixture, added, key)
+
+
 class Group(TopLevelObject):
 
     file_node_str = 'group'
     noun = kw.GROUP
 
     def __init__(self, fixtures: List['Fixture'] = None, *args, **kwargs):
-        if not fixtures:
-            self.fixtures = []
-        else:
-            self.fixtures = fixtures
+        self.fixtures = FixtureSet(fixtures, self)
         super().__init__(*args, **kwargs)
 
     def _read_json(self, json_object):
         super()._read_json(json_object)
-        for fix in json_object['fixtures']:
-            self.fixtures.append(fix)
+        self.fixtures = FixtureSet(json_object['fixtures'], self)
 
     def json(self):
         json_object = super().json()
-        json_object['fixtures'] = [i.uuid for i in self.fixtures]
+        json_object['fixtures'] = self.fixtures.uuids()
         return json_object
 
     def get_text_widget(self):
@@ -516,33 +2413,52 @@ class Group(TopLevelObject):
         return [(self.file_node_str, str(self.ref)), ' ', label, ' (',
                 str(len(self.fixtures)), ' fixtures)']
 
+    def _copy_from(self, other):
+        super()._copy_from(other)
+        self.fixtures = FixtureSet(other.fixtures, self)
+
+    def resolve_references(self, lookup):
+        return self.fixtures.resolve(lookup)
+
+    def fixtures_changed(self, fixture: 'Fixture', added, key):
+        """Called by the FixtureSet of this group whenever it is modified."""
+        if self._document:
+            self._document._group_fixture_changed(self, fixture.uuid, added)
+            self._document._object_changed(self)
+            if added:
+                self._document._record_undo(self.fixtures.remove, fixture)
+            else:
+                self._document._record_undo(self.fixtures.insert, key, fixture)
+
     def append_fixture(self, fixture: 'Fixture'):
-        """Add a fixture to the end of the group listing."""
+        """Add a fixture to the end of the group listing, if it is not
+        already in the group."""
         self.fixtures.append(fixture)
 
+    def remove_fixture(self, fixture: 'Fixture'):
+        """Remove a fixture from the group."""
+        self.fixtures.remove(fixture)
+
 
 class Palette(TopLevelObject):
 
     palette_prefix = ''
 
     def __init__(self, levels: List['FunctionLevel'] = None, *args, **kwargs):
-        if not levels:
-            self.levels = []
-        else:
-            self.levels = levels
+        self.levels = LevelMap(levels, self)
         super().__init__(*args, **kwargs)
 
+    def _copy_from(self, other):
+        super()._copy_from(other)
+        self.levels = other.levels.share(self)
+
     def _read_json(self, json_object):
         super()._read_json(json_object)
-        for func, val in json_object['levels'].items():
-            self.levels.append(FunctionLevel(func, val))
+        self.levels.merge_levels(json_object['levels'])
 
     def json(self):
         json_object = super().json()
-        levels = {}
-        for l in self.levels:
-            levels[l.function] = l.value
-        json_object['levels'] = levels
+        json_object['levels'] = dict(self.levels.items())
         return json_object
 
     def get_text_widget(self):
@@ -554,9 +2470,23 @@ class Palette(TopLevelObject):
                 label, ' (', str(len(self.levels)), ' levels)']
 
     def get_function_level(self, func):
-        for l in self.levels:
-            if func.uuid == l.function:
-                return l.value
+        level = self.levels.get(func.uuid)
+        if level:
+            return level.value
+
+    def levels_changed(self):
+        """Called by the LevelMap of this palette whenever it is modified."""
+        self._data_changed()
+
+    def set_levels(self, levels: dict):
+        """Replace all levels in this palette with a dict of function
+        uuids and their values."""
+        self.levels.set_levels(levels)
+
+    def merge_levels(self, levels: dict):
+        """Add or update levels in this palette from a dict of function
+        uuids and their values, leaving all other levels as they are."""
+        self.levels.merge_levels(levels)
 
 
 class AllPalette(Palette):
@@ -614,20 +2544,37 @@ class Registry(TopLevelObject):
     file_node_str = 'registry'
     noun = kw.REGISTRY
 
+    # Bitmask with a set bit for every valid DMX address. Bit n represents
+    # address n, so bit 0 is never used.
+    all_addresses = ((1 << (UNIVERSE_SIZE + 1)) - 1) & ~1
+
     def __init__(self, entries: List['PatchEntry'] = None, *args, **kwargs):
-        if not entries:
-            self.entries: List['PatchEntry'] = []
-        else:
-            self.entries = entries
-        self.table = {}
-        self._update_table()
+        # Patch entries are stored keyed both by the function they patch
+        # and by each address they occupy, so that patching and
+        # unpatching only ever touch the entries being changed
+        self._function_entries = {}
+        self._address_entries = {}
+        # Occupancy bitmap of the universe, in the same form as
+        # all_addresses. It is kept in step with the entries by _add_entry
+        # and _remove_entry, so is never recorded as a change of its own.
+        self._occupancy = 0
+        if entries:
+            for pe in entries:
+                self._add_entry(pe)
         super().__init__(*args, **kwargs)
 
+    def _copy_from(self, other):
+        super()._copy_from(other)
+        self._function_entries = {}
+        self._address_entries = {}
+        self._occupancy = 0
+        for pe in other.entries:
+            self._add_entry(PatchEntry(pe.function, list(pe.addresses)))
+
     def _read_json(self, json_object):
         super()._read_json(json_object)
         for uuid, addrs in json_object.get('entries', {}).items():
-            self.entries.append(PatchEntry(uuid, [int(i) for i in addrs]))
-        self._update_table()
+            self._add_entry(PatchEntry(uuid, [int(i) for i in addrs]))
 
     def json(self):
         json_object = super().json()
@@ -639,62 +2586,99 @@ class Registry(TopLevelObject):
 
     def get_text_widget(self):
         return ['Universe ', (self.file_node_str, str(self.ref)), ' - ',
-                str(len(self.table)), ' occupied']
-
-    def _update_table(self):
-        for pe in self.entries:
-            for addr in pe.addresses:
-                self.table[addr] = pe.function
+                str(len(self._address_entries)), ' occupied']
+
+    @property
+    def entries(self):
+        """A list of all patch entries in the registry."""
+        return list(self._function_entries.values())
+
+    @property
+    def table(self):
+        """A dict of the function uuid patched at each occupied address."""
+        return {addr: pe.function for addr, pe in self._address_entries.items()}
+
+    def _add_entry(self, pe: 'PatchEntry'):
+        """Add a patch entry, replacing any existing entry for the same
+        function."""
+        if pe.function in self._function_entries:
+            self._remove_entry(pe.function)
+        self._function_entries[pe.function] = pe
+        for addr in pe.addresses:
+            self._address_entries[addr] = pe
+            self._occupancy |= 1 << addr
+        if self._document:
+            self._document._index_patch(self, pe)
+            self._document._record_undo(self._remove_entry, pe.function)
+
+    def _remove_entry(self, function_uuid: str):
+        """Remove the patch entry of a function, if there is one."""
+        pe = self._function_entries.pop(function_uuid, None)
+        if not pe:
+            return
+        for addr in pe.addresses:
+            if self._address_entries.get(addr) is pe:
+                del self._address_entries[addr]
+                self._occupancy &= ~(1 << addr)
+        if self._document:
+            self._document._unindex_patch(self, pe)
+            self._document._record_undo(self._add_entry, pe)
+
+    def get_entry(self, addr: int):
+        """Get the patch entry occupying an address, if any."""
+        return self._address_entries.get(addr)
 
     def get_occupied(self):
         """Return a list of occupied addresses."""
-        return sorted([int(d) for d in self.table.keys()])
+        return sorted(self._address_entries)
 
     def get_available(self):
         """Return a list of available addresses in the DMX512 space."""
-        all_addrs = [i for i in range(1, 513)]
-        occupied = self.get_occupied()
-        available = [i for i in all_addrs if i not in occupied]
-        return sorted(available)
+        return [i for i in range(1, UNIVERSE_SIZE + 1) if not self._occupancy >> i & 1]
 
     def get_start_address(self, n):
         """Get the earliest available start address for a fixture
         requiring n channels."""
-        available = self.get_available()
-        for addr in available:
-            if set([i for i in range(addr, addr + n)]).issubset(available):
-                return addr
-        raise exception.InsufficientAvailableChannels(self, n)
+        # Narrow the free bitmap down so that a bit is only set if it
+        # begins a free run of at least n addresses. Each step doubles the
+        # length of run being checked, so this takes log(n) operations on
+        # the bitmap rather than testing every address individually.
+        runs = self.all_addresses & ~self._occupancy
+        width = 1
+        while width < n and runs:
+            step = min(width, n - width)
+            runs &= runs >> step
+            width += step
+        if not runs:
+            raise exception.InsufficientAvailableChannels(self, n)
+        return (runs & -runs).bit_length() - 1
 
     def is_valid_start(self, start, n):
         """Given a start address and n required channels, will the
         patch fit?"""
-        available = self.get_available()
-        if set(range(start, start + n)).issubset(available):
-            return True
+        if start < 1 or start + n - 1 > UNIVERSE_SIZE:
+            return False
+        return not self._occupancy & (((1 << n) - 1) << start)
 
     def get_function_patch(self, func: 'FixtureFunction'):
         """Get the address number of a function in the registry table,
         if it exists there."""
-        for pe in self.entries:
-            if pe.function == func.uuid:
-                return pe.addresses
+        pe = self._function_entries.get(func.uuid)
+        if pe:
+            return pe.addresses
 
     def get_fixture_patch(self, fix: 'Fixture'):
         """Get an iterator of the patch locations of any functions
         patched in this registry of a given fixture."""
-        func_uuids = [func.uuid for func in fix.functions]
-        for addr, uuid in self.table.items():
-            if uuid in func_uuids:
-                yield addr
+        for func in fix.functions:
+            pe = self._function_entries.get(func.uuid)
+            if pe:
+                yield from pe.addresses
 
     def unpatch_function(self, func: 'FixtureFunction'):
         """Remove a function from the registry table, if it is
         patched there."""
-        for pe in self.entries:
-            if pe.function == func.uuid:
-                self.entries.remove(pe)
-        self._update_table()
+        self._remove_entry(func.uuid)
 
     def patch_fixture(self, fixture: 'Fixture', addr: int = None):
         """Patch all channels of a fixture from a given start address,
@@ -703,22 +2687,23 @@ class Registry(TopLevelObject):
             addr = self.get_start_address(fixture.dmx_size())
         if not self.is_valid_start(addr, fixture.dmx_size()):
             raise exception.InsufficientAvailableChannels(self, fixture.dmx_size())
-        for func in fixture.physical_functions():
-            self.entries.append(PatchEntry(func.uuid, [addr + i - 1 for i in func.offset]))
-        self._update_table()
+        # Subscribers are told about the whole fixture at once
+        with self._document.batch() if self._document else nullcontext():
+            for func in fixture.physical_functions():
+                self._add_entry(PatchEntry(func.uuid, [addr + i - 1 for i in func.offset]))
 
     def unpatch_fixture(self, fixture: 'Fixture'):
         """Unpatch all channels of a fixture which appear in this
         registry."""
-        func_ids = [i.uuid for i in fixture.functions]
-        for pe in self.entries:
-            if pe.function in func_ids:
-                self.entries.remove(pe)
-        self._update_table()
+        with self._document.batch() if self._document else nullcontext():
+            for func in fixture.functions:
+                self._remove_entry(func.uuid)
 
 
 class PatchEntry:
 
+    __slots__ = ('addresses', 'function')
+
     def __init__(self, function: str, addresses: List[int]):
         self.addresses = addresses
         self.function = function
@@ -735,6 +2720,10 @@ class Structure(ArbitraryDataObject):
         super().__init__(data={'structure_type': structure_type},
                          *args, **kwargs)
 
+    def _read_json(self, json_object):
+        super()._read_json(json_object)
+        self.data['structure_type'] = json_object.get('structure_type')
+
     def get_text_widget(self):
         if not self.label:
             label = UNLABELLED_STRING
@@ -754,3 +2743,4 @@ COMMAND_STR_MAP = {obj.noun: obj for obj in ALL_TYPES}
 FILE_NODE_STR_MAP = {obj.file_node_str: obj for obj in ALL_TYPES}
 PALETTE_PREFIXES = {obj.palette_prefix: obj for obj in ALL_TYPES if
                     obj.__base__ == Palette}
+PALETTE_TYPES = list(PALETTE_PREFIXES.values())
@@ -128,6 +128,12 @@ class ApplicationView:
         self.fixed_walker.clear()
         self.fixed_walker.extend(sheet_list)
 
+    def append_to_sheet(self, widget):
+        self.fixed_walker.append(widget)
+
+    def remove_from_sheet(self, widget):
+        self.fixed_walker.remove(widget)
+
 
 class Application:
 
@@ -137,13 +143,20 @@ class Application:
         self.cmd = CommandLine(self.config)
         self.view = ApplicationView(self.cmd)
         self.message_bus = MessageBus(self.view.history, self.view.dynamic_walker, self.config)
+        # The context the sheet is showing, if any, the text widget of each
+        # object in the sheet, and the version of the document it shows
+        self.sheet_context = None
+        self.sheet_widgets = {}
+        self.sheet_version = None
 
     def bind(self, command_interpreter, post_function):
         self.cmd.bind(command_interpreter, post_function)
         self.update_context(self.config['cli']['default-context'])
 
     def _generate_sheet_list(self, context):
-        text_widgets = []
+        self.sheet_context = context
+        self.sheet_widgets = {}
+        self.sheet_version = self.file.version
         if context in document.COMMAND_STR_MAP:
             context_objects = self.file.get_by_type(
                 document.COMMAND_STR_MAP[context]
@@ -151,8 +164,8 @@ class Application:
         else:
             context_objects = []
         for obj in context_objects:
-            text_widgets.append(urwid.Text(obj.get_text_widget()))
-        return text_widgets
+            self.sheet_widgets[obj.uuid] = urwid.Text(obj.get_text_widget())
+        return list(self.sheet_widgets.values())
 
     def _generate_history_list(self):
         text_widgets = []
@@ -166,9 +179,40 @@ class Application:
         self.view.update_sheet(sheet_list)
 
     def update_view(self):
-        self.view.update_sheet(self._generate_sheet_list(self.cmd.context))
+        """Update the sheet with the objects which have changed since it
+        was last shown, or redraw it entirely if it is showing something
+        else."""
+        changes = None
+        if self.sheet_context == self.cmd.context:
+            changes = self.file.changes_since(self.sheet_version)
+        if changes is None:
+            self.view.update_sheet(self._generate_sheet_list(self.cmd.context))
+            return
+        self.sheet_version = self.file.version
+        context_type = document.COMMAND_STR_MAP.get(self.cmd.context)
+        removed = [uuid for uuid, kind in changes.items()
+                   if kind == document.CHANGE_REMOVE and uuid in self.sheet_widgets]
+        if len(removed) == 1:
+            self.view.remove_from_sheet(self.sheet_widgets.pop(removed[0]))
+        elif removed:
+            # Removing widgets one at a time searches the sheet for each,
+            # so the sheet is redrawn from the widgets which are left
+            for uuid in removed:
+                del self.sheet_widgets[uuid]
+            self.view.update_sheet(list(self.sheet_widgets.values()))
+        for uuid, kind in changes.items():
+            if kind == document.CHANGE_REMOVE:
+                continue
+            if uuid in self.sheet_widgets:
+                self.sheet_widgets[uuid].set_text(self.file.get_by_uuid(uuid).get_text_widget())
+            elif kind == document.CHANGE_INSERT:
+                obj = self.file.get_by_uuid(uuid)
+                if context_type and type(obj) is context_type:
+                    self.sheet_widgets[uuid] = urwid.Text(obj.get_text_widget())
+                    self.view.append_to_sheet(self.sheet_widgets[uuid])
 
     def display_history(self):
+        self.sheet_context = None
         self.view.update_sheet(self._generate_history_list())
 
 
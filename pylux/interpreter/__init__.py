@@ -1,4 +1,4 @@
-from pylux import clihelper, document
+from pylux import clihelper, document, sqlitedocument
 from pylux.lib import exception, data
 from importlib import import_module
 import os.path
@@ -96,23 +96,43 @@ class Interpreter:
     def register_commands(self):
         self.register_command(NoRefsCommand((kw.FILE, kw.WRITE), self.file_write))
         self.register_command(NoRefsCommand((kw.FILE, kw.WRITE_TO), self.file_writeto))
+        self.register_command(NoRefsCommand((kw.FILE, kw.COMPACT), self.file_compact))
         self.register_command(NoRefsCommand((kw.PROGRAM, kw.EXIT), self.program_abort))
         self.register_command(NoRefsCommand((kw.PROGRAM, kw.WRITE_EXIT), self.program_exit))
         self.register_command(NoRefsCommand((kw.PROGRAM, kw.RELOAD_CONFIG), self.reload_config))
+        self.register_command(NoRefsCommand((kw.PROGRAM, kw.UNDO), self.program_undo))
+        self.register_command(NoRefsCommand((kw.PROGRAM, kw.REDO), self.program_redo))
 
     def file_write(self):
         """Save changes to the default write location. If no write location has been
-        set since opening the program, this will be the same as the load location."""
-        self.file.write_file(self.config['main']['load_file'])
+        set since opening the program, this will be the same as the load location.
+        If journaling is enabled, only the changes since the last save are written,
+        to the journal of the file."""
+        if self.config['main'].getboolean('journal', fallback=False):
+            self.file.write_journal(self.config['main']['load_file'])
+        else:
+            self.file.write_file(self.config['main']['load_file'])
         self.msg.post_feedback('Saved to '+self.config['main']['load_file'])
 
     def file_writeto(self, location):
         """Change the default write location and then save the file there. Any future
-        saves using File Write will also save to this location."""
+        saves using File Write will also save to this location. Documents can
+        be written to any JSON file, but only a SQLite document can be written
+        to a database, and then only to its own."""
+        if (sqlitedocument.is_sqlite_path(location) and
+                os.path.abspath(location) != getattr(self.file, 'db_path', None)):
+            self.msg.post_feedback('Error: Can only write to a database by opening it')
+            return
         self.config['main']['load_file'] = location
         self.msg.post_feedback('Set default save location to '+location)
         self.file_write()
 
+    def file_compact(self):
+        """Save the whole document to the default write location, folding in and
+        removing the journal of changes from previous saves."""
+        self.file.write_file(self.config['main']['load_file'])
+        self.msg.post_feedback('Saved to '+self.config['main']['load_file'])
+
     def program_abort(self):
         """Exit the program immediately without saving changes to disk."""
         for ext in self.extensions:
@@ -123,8 +143,9 @@ class Interpreter:
         raise exception.ProgramExit
 
     def program_exit(self):
-        """Save changes to the default write location, then exit the program."""
-        self.file_write()
+        """Save changes to the default write location, then exit the program.
+        The whole document is written, so any journal is folded into the file."""
+        self.file_compact()
         self.program_abort()
 
     def reload_config(self):
@@ -135,6 +156,22 @@ class Interpreter:
         Settings changed on a per-file basis will not be affected."""
         self.config.read([os.path.join(data.LOCATIONS[i], 'config.ini') for i in reversed(data.PRIORITY)])
 
+    def program_undo(self):
+        """Undo the last command which changed the file. All the changes made by a
+        command are undone together."""
+        if self.file.undo():
+            self.msg.post_feedback('Undid the last command')
+        else:
+            self.msg.post_feedback('Error: Nothing to undo')
+
+    def program_redo(self):
+        """Redo the last command to be undone. Running any other command which changes
+        the file discards the commands which could be redone."""
+        if self.file.redo():
+            self.msg.post_feedback('Redid the last undone command')
+        else:
+            self.msg.post_feedback('Error: Nothing to redo')
+
     def _get_init_keywords(self):
         """Get all the keywords which could be the first keyword of a command."""
         init_keywords = []
@@ -201,6 +238,11 @@ class Interpreter:
                                 ' requires at least '+str(len(command.req_params))+' parameters'])
 
     def process_command(self, posted_command):
+        # Every change made by the command is undone and redone together
+        with self.file.operation():
+            self._process_command(posted_command)
+
+    def _process_command(self, posted_command):
 
         def calculate_params(n, params):
             """Based on the command given, determine how many parameters are expected. Then shrink the number of
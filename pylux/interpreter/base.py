@@ -106,42 +106,45 @@ class BaseExtension(InterpreterExtension):
         # destination object at the same time
         if len(objs) > 1 and len(dest_refs) > 1:
             self.post_feedback(exception.ERROR_MSG_OVERLAPPING_RANGE)
-        # If there is one source object and one or more destination object,
-        # duplicates are made at whole number intervals in the destination range
-        elif len(objs) == 1 and len(dest_refs) >= 1:
-            src_obj = objs[0]
-            for dest_ref in dest_refs:
-                try:
-                    self.file.duplicate_object(src_obj, dest_ref)
-                except exception.ObjectAlreadyExistsError as e:
-                    self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(e.obj_type, e.ref))
-        # If there are multiple source objects and only one destination object,
-        # the first source object is duplicated at the destination ref. Then, for
-        # each following source object, the destination ref is incremented by the
-        # same amount as the difference between the current and previous source
-        # objects. For example, if the sources are 1,2,5,7 and the given
-        # destination is 9, the used destinations will be 9,10,13,15
-        elif len(objs) > 1 and len(dest_refs) == 1:
-            for src_obj in objs:
-                dest_ref = decimal.Decimal(dest_refs[0]) + decimal.Decimal(src_obj.ref) - decimal.Decimal(objs[0].ref)
-                # Unlike for a single-source clone command, this requires us to
-                # fetch a new source object on every iteration
-                try:
-                    self.file.duplicate_object(src_obj, dest_ref)
-                except exception.ObjectAlreadyExistsError as e:
-                    self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(e.obj_type, e.ref))
+            return
+        with self.file.batch():
+            # If there is one source object and one or more destination object,
+            # duplicates are made at whole number intervals in the destination range
+            if len(objs) == 1 and len(dest_refs) >= 1:
+                src_obj = objs[0]
+                for dest_ref in dest_refs:
+                    try:
+                        self.file.duplicate_object(src_obj, dest_ref)
+                    except exception.ObjectAlreadyExistsError as e:
+                        self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(e.obj_type, e.ref))
+            # If there are multiple source objects and only one destination object,
+            # the first source object is duplicated at the destination ref. Then, for
+            # each following source object, the destination ref is incremented by the
+            # same amount as the difference between the current and previous source
+            # objects. For example, if the sources are 1,2,5,7 and the given
+            # destination is 9, the used destinations will be 9,10,13,15
+            elif len(objs) > 1 and len(dest_refs) == 1:
+                for src_obj in objs:
+                    dest_ref = decimal.Decimal(dest_refs[0]) + decimal.Decimal(src_obj.ref) - decimal.Decimal(objs[0].ref)
+                    # Unlike for a single-source clone command, this requires us to
+                    # fetch a new source object on every iteration
+                    try:
+                        self.file.duplicate_object(src_obj, dest_ref)
+                    except exception.ObjectAlreadyExistsError as e:
+                        self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(e.obj_type, e.ref))
 
     def _base_create(self, refs, obj_type, allow_autoref=True, **kwargs):
         """Create new objects."""
-        for r in refs:
-            if self.file.get_by_ref(obj_type, r):
-                self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(obj_type.noun, str(r)))
-                continue
-            # If ref is zero, use automatically assigned ref. If autoref is not
-            # allowed, then an object will be created at ref zero
-            if r == 0 and allow_autoref:
-                r = self.file.next_ref(obj_type)
-            self.file.insert_object(obj_type(ref=Decimal(r), **kwargs))
+        with self.file.batch():
+            for r in refs:
+                if self.file.get_by_ref(obj_type, r):
+                    self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(obj_type.noun, str(r)))
+                    continue
+                # If ref is zero, use automatically assigned ref. If autoref is not
+                # allowed, then an object will be created at ref zero
+                if r == 0 and allow_autoref:
+                    r = self.file.next_ref(obj_type)
+                self.file.insert_object(obj_type(ref=Decimal(r), **kwargs))
 
     def _base_display(self, objs):
         """Print a single-line summary of a range of objects."""
@@ -158,12 +161,15 @@ class BaseExtension(InterpreterExtension):
             return
         v_i = v_0
         incr = (v_n - v_0) / (len(objs) - 1)
-        for obj in objs:
-            if type(obj).__base__ is not document.ArbitraryDataObject:
-                self.post_feedback(exception.ERROR_MSG_UNSUPPORTED_DATA.format(obj.noun))
-                continue
-            obj.data[k] = str(v_i)
-            v_i += incr
+        # The tag index of the document is updated as each value is set, and
+        # subscribers are told once at the end
+        with self.file.batch():
+            for obj in objs:
+                if type(obj).__base__ is not document.ArbitraryDataObject:
+                    self.post_feedback(exception.ERROR_MSG_UNSUPPORTED_DATA.format(obj.noun))
+                    continue
+                obj.data[k] = str(v_i)
+                v_i += incr
 
     def _base_label(self, objs, label):
         """Set the label attribute for an object."""
@@ -172,40 +178,29 @@ class BaseExtension(InterpreterExtension):
 
     def _base_levels_query(self, objs, nips=True, track=False):
         """See the stored level values of all parameter types. Works with objects that
-        use the levels key. Set nips to False to only show intensity values. Supply a list of
-        levels-supporting objects as the precedent parameter to have these evaluated first and
-        their levels carried forward to later objects in the list. For example, provide a list
-        of all cues in a cue list to get the tracked values. If a match with the current cue is
-        found in precedent, any later objects in the precedent list will be ignored."""
+        use the levels key. Set nips to False to only show intensity values. Set track to
+        show the tracked values of cues, carried forward from earlier cues in the same cue
+        list."""
         for obj in objs:
             if not hasattr(obj, 'levels'):
                 self.post_feedback([obj.noun + ' does not support levels query'])
                 continue
             self.post_output([obj.get_text_widget()])
-            # If the tracking flag is set, create a list of all cues in the cue list of the given cue
+            # If the tracking flag is set, get the tracked state of the cue from its
+            # cue list, otherwise just use the levels stored in the object itself
             if track and type(obj) == document.Cue:
-                precedent = self.file.filter_type_by_params(document.Cue, [('cue_list', obj.get('cue_list'))])
+                state = self.file.get_tracked_levels(obj)
             else:
-                precedent = []
-            # Add the main object to the precedent list so that the break clause can be executed
-            # in case the object itself isn't already on the precedent list
-            precedent.append(obj)
+                state = {level.function: (level, obj) for level in obj.levels}
             tracked_values = {}
-            for preceding_obj in precedent:
-                for level in preceding_obj.levels:
-                    func = self.file.get_function_by_uuid(level.function)
-                    fix = self.file.get_function_parent(func)
-                    tracked_values[func.uuid] = (func, fix, level.value, preceding_obj)
-                # If the object just added was the main object, we do not want to continue with the
-                # rest of the precedent list, so execute the break clause. Because the main object is
-                # always appended to the precedent list, the clause will always be executed eventually,
-                # even if it isn't until the end of the list has been reached
-                if preceding_obj.uuid == obj.uuid:
-                    break
+            for level, source in state.values():
+                func = self.file.get_function_by_uuid(level.function)
+                fix = self.file.get_function_parent(func)
+                tracked_values[func.uuid] = (func, fix, level, source)
             for tv in tracked_values.values():
                 if tv[0].parameter == self.interpreter.config['cli']['dimmer-attribute-name'] or nips:
                     level_str = printer.get_pretty_level_string(
-                        str(tv[2]), doc=self.file,
+                        tv[2], doc=self.file,
                         show_labels=self.interpreter.config['cli'].getboolean('show-reference-labels'),
                         raw_data=self.interpreter.config['cli'].getboolean('show-raw-data'), function=tv[0])
                     if tv[3].uuid == obj.uuid:
@@ -218,19 +213,19 @@ class BaseExtension(InterpreterExtension):
 
     def _base_remove(self, objs):
         """Remove an object from the document."""
-        for obj in objs:
-            self.file.remove_object(obj)
+        self.file.remove_many(objs)
 
     def _base_set(self, objs, k, v=None):
         """Set an arbitrary data tag to a value."""
-        for obj in objs:
-            if type(obj).__base__ is not document.ArbitraryDataObject:
-                self.post_feedback(exception.ERROR_MSG_UNSUPPORTED_DATA.format(obj.noun))
-                return
-            if not v:
-                obj.data.pop(k, None)
-            else:
-                obj.data[k] = v
+        with self.file.batch():
+            for obj in objs:
+                if type(obj).__base__ is not document.ArbitraryDataObject:
+                    self.post_feedback(exception.ERROR_MSG_UNSUPPORTED_DATA.format(obj.noun))
+                    return
+                if not v:
+                    obj.data.pop(k, None)
+                else:
+                    obj.data[k] = v
 
     def cue_about(self, cues):
         """Show stored intensity data for a cue."""
@@ -514,6 +509,7 @@ class BaseExtension(InterpreterExtension):
         """Show a summary of the used addresses in a registry but do not provide any further information."""
         for reg in registries:
             self.post_output([reg.get_text_widget()])
+            occupied = set(reg.get_occupied())
             table = []
             current_row = ['   ']
             width = int(self.interpreter.config['cli']['registry-summary-width'])
@@ -523,7 +519,7 @@ class BaseExtension(InterpreterExtension):
                 if i % width == 1 or i == 513:
                     table.append(current_row)
                     current_row = [str(format(i, '03d')), '  ']
-                if str(i) in reg.table or i in reg.table:
+                if i in occupied:
                     current_row.append(('error', '#  '))
                 else:
                     current_row.append(('success', '-  '))
@@ -541,8 +537,8 @@ class BaseExtension(InterpreterExtension):
         """Show all used addresses in a registry and the functions they are occupied by."""
         for reg in registries:
             self.post_output([reg.get_text_widget()])
-            for addr, uuid in sorted(reg.table.items()):
-                func = self.file.get_function_by_uuid(uuid)
+            for addr in reg.get_occupied():
+                func = self.file.get_function_by_uuid(reg.get_entry(addr).function)
                 fix = self.file.get_function_parent(func)
                 self.post_output([['DMX', str(format(addr, '03d')), ': '] +
                                   fix.get_text_widget() + [' ('] +
@@ -21,6 +21,11 @@ class EosExtension(InterpreterExtension):
         except FileNotFoundError:
             self.post_feedback(exception.ERROR_MSG_NO_FILE.format(file))
             return
+        # Imports insert thousands of objects, so are done in one batch
+        with self.file.batch():
+            self._import_ascii(ascii_file, overwrite)
+
+    def _import_ascii(self, ascii_file, overwrite):
         for eos_fix in ascii_file.patch:
             ref = Decimal(ascii_file.sortable_chan(eos_fix))
             if self.file.get_by_ref(document.Fixture, ref) and not overwrite:
@@ -59,24 +64,27 @@ class EosExtension(InterpreterExtension):
         for eos_group in ascii_file.groups:
             new_group = document.Group(ref=Decimal(eos_group.id))
             for eos_fix in eos_group.chans:
-                fix = self.file.get_by_ref(document.Fixture, Decimal(ascii_file.sortable_chan(eos_fix)))
-                new_group.fixtures.append(fix)
+                fix = self.file.get_by_ref(document.Fixture, ascii_file.sortable_chan(eos_fix))
+                if fix:
+                    new_group.append_fixture(fix)
             if eos_group.label:
                 new_group.label = eos_group.label
             self.file.insert_object(new_group)
 
         def add_palette(palette_type, ascii_palette):
             new_palette = palette_type(ref=Decimal(ascii_palette.id), label=ascii_palette.label)
+            levels = {}
             for eos_param in ascii_palette.params:
                 try:
-                    fix = self.file.get_by_ref(document.Fixture, Decimal(ascii_file.sortable_chan(eos_param.chan)))
+                    fix = self.file.get_by_ref(document.Fixture, ascii_file.sortable_chan(eos_param.chan))
                 except AttributeError:
                     self.post_feedback(exception.ERROR_MSG_UNPATCHED_FIXTURE.format(
                         str(eos_param.chan_id), new_palette.noun, str(new_palette.ref)))
                     continue
                 func_uuid = fix.get_function(
                     reference.EOS_GDTF_MAP.get(eos_param.param.long_name, eos_param.param.long_name)).uuid
-                new_palette.levels.append(document.FunctionLevel(func_uuid, eos_param.level))
+                levels[func_uuid] = eos_param.level
+            new_palette.set_levels(levels)
             self.file.insert_object(new_palette)
 
         for ip in ascii_file.intensity_palettes:
@@ -92,20 +100,21 @@ class EosExtension(InterpreterExtension):
             for ascii_cue in cue_list.cues:
                 new_cue = document.Cue(ref=Decimal(ascii_cue.id), label=ascii_cue.label,
                                        cue_list=int(cue_list.id))
+                levels = {}
                 # Scanning moves, tracked and params are all very similar, there
                 # is a lot of repetition here
                 for eos_move in ascii_cue.moves:
                     try:
-                        fix = self.file.get_by_ref(document.Fixture, Decimal(ascii_file.sortable_chan(eos_move.chan)))
+                        fix = self.file.get_by_ref(document.Fixture, ascii_file.sortable_chan(eos_move.chan))
                     except AttributeError:
                         self.post_feedback(exception.ERROR_MSG_UNPATCHED_FIXTURE.format(
                             str(eos_move.chan_id), new_cue.noun, str(new_cue.ref)))
                         continue
                     func_uuid = fix.get_dimmer_function().uuid
-                    new_cue.levels.append(document.FunctionLevel(func_uuid, eos_move.level))
+                    levels[func_uuid] = eos_move.level
                 for eos_chan in ascii_cue.tracked:
                     try:
-                        fix = self.file.get_by_ref(document.Fixture, Decimal(ascii_file.sortable_chan(eos_chan.chan)))
+                        fix = self.file.get_by_ref(document.Fixture, ascii_file.sortable_chan(eos_chan.chan))
                     except AttributeError:
                         self.post_feedback(exception.ERROR_MSG_UNPATCHED_FIXTURE.format(
                             str(eos_chan.chan_id), new_cue.noun, str(new_cue.ref)))
@@ -117,14 +126,11 @@ class EosExtension(InterpreterExtension):
                     # check the entirety of each. It doesn't really matter which of
                     # the move or track values takes precedence; they are both the
                     # same every time.
-                    for level in new_cue.levels:
-                        if level.function == func_uuid:
-                            new_cue.levels.remove(level)
-                            break
-                    new_cue.levels.append(document.FunctionLevel(func_uuid, eos_chan.level))
+                    levels.pop(func_uuid, None)
+                    levels[func_uuid] = eos_chan.level
                 for eos_param in ascii_cue.params:
                     try:
-                        fix = self.file.get_by_ref(document.Fixture, Decimal(ascii_file.sortable_chan(eos_param.chan)))
+                        fix = self.file.get_by_ref(document.Fixture, ascii_file.sortable_chan(eos_param.chan))
                     except AttributeError:
                         self.post_feedback(exception.ERROR_MSG_UNPATCHED_FIXTURE.format(
                             str(eos_param.chan_id), new_cue.noun, str(new_cue.ref)))
@@ -137,11 +143,9 @@ class EosExtension(InterpreterExtension):
                     # are preferred to the moves or chans values as they can include
                     # referenced values whereas the others cannot)
                     if func_name == document.DIMMER_PARAM_NAME:
-                        for level in new_cue.levels:
-                            if level.function == func_uuid:
-                                new_cue.levels.remove(level)
-                                break
-                    new_cue.levels.append(document.FunctionLevel(func_uuid, eos_param.level))
+                        levels.pop(func_uuid, None)
+                    levels[func_uuid] = eos_param.level
+                new_cue.set_levels(levels)
                 self.file.insert_object(new_cue)
 
 
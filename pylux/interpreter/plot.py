@@ -4,7 +4,6 @@ from pylux.lib import data, tagger, plothelper
 import xml.etree.ElementTree as ET
 import os
 from ast import literal_eval
-import decimal
 import pylux.lib.keyword as kw
 
 
@@ -380,8 +379,8 @@ class LightingPlot:
         self.lighting_plot = self.get_empty_plot()
         canvas = plothelper.Canvas(self.options)
         root = self.lighting_plot.getroot()
-        visualised_fixtures = [x.ref for x in clihelper.match_objects(
-            self.options['output-fixture-filter'], self.plot_file, document.Fixture)]
+        visualised_fixtures = {x.ref_key for x in clihelper.match_objects(
+            self.options['output-fixture-filter'], self.plot_file, document.Fixture)}
         if self.options.getboolean('page-border'):
             root.append(plothelper.PageBorderComponent(canvas).plot_component)
         try:
@@ -405,7 +404,7 @@ class LightingPlot:
                 fixture_components.append(plothelper.FixtureComponent(fixture, canvas))
         for fixture_component in fixture_components:
             if self.options.getboolean('visualise-output') and \
-                    decimal.Decimal(fixture_component.fixture.ref) in visualised_fixtures:
+                    fixture_component.fixture.ref_key in visualised_fixtures:
                 canvas.lighting_filter.add_filter(fixture_component)
             if self.options.getboolean('show-beams'):
                 root.append(plothelper.FixtureBeamComponent(fixture_component, canvas).plot_component)
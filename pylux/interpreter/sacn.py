@@ -52,7 +52,7 @@ class SacnExtension(InterpreterExtension):
         for level in cue.levels:
             function = self.file.get_function_by_uuid(level.function)
             reg, addr = self.file.get_function_patch(function)
-            val = self.file.get_raw_cue_level(cue, function)
+            val = self.file.get_raw_level(level, function)
             if len(addr) == 1:
                 packet_manager.apply_level(int(reg.ref) + 1, addr[0], val)
             elif len(addr) == 2:
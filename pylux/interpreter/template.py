@@ -41,7 +41,7 @@ class TemplateExtension(InterpreterExtension):
                     offset = None
                 else:
                     offset = dmx_chan.offset
-                fix.functions.append(document.FixtureFunction(
+                self.file.add_function(fix, document.FixtureFunction(
                     parameter=str(dmx_chan.logical_channels[0].attribute), offset=offset))
 
     def fixture_createfrom(self, refs, template):
@@ -56,8 +56,9 @@ class TemplateExtension(InterpreterExtension):
                 self.post_feedback(exception.ERROR_MSG_EXISTING_OBJECT.format(
                     document.Fixture.noun, str(r)))
                 continue
-            self.file.insert_object(document.Fixture(ref=Decimal(r)))
-            self.fixture_completefrom([Decimal(r)], template)
+            new_fixture = document.Fixture(ref=Decimal(r))
+            self.file.insert_object(new_fixture)
+            self.fixture_completefrom([new_fixture], template)
 
 
 def register_extension(interpreter):
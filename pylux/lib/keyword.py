@@ -17,6 +17,7 @@ STRUCTURE = 'Structure'
 ABOUT = 'About'
 APPEND = 'Append'
 CLONE = 'CopyTo'
+COMPACT = 'Compact'
 CREATE = 'Create'
 CREATE_FROM = 'CreateFrom'
 COMPLETE_FROM = 'CompleteFrom'
@@ -37,12 +38,15 @@ WRITE_TO = 'WriteTo'
 WRITE_EXIT = 'WriteAndQuit'
 EXIT = 'Quit'
 RELOAD_CONFIG = 'ReloadConfig'
+UNDO = 'Undo'
+REDO = 'Redo'
 
 NOUNS = [CUE, FILE, FILTER, FIXTURE, GROUP, META, ALL_PALETTE,
          INTENSITY_PALETTE, FOCUS_PALETTE, COLOUR_PALETTE, BEAM_PALETTE,
          PLOT, PROGRAM, REGISTRY, REPORT, STRUCTURE]
-VERBS = [ABOUT, APPEND, CLONE, CREATE, CREATE_FROM, COMPLETE_FROM, DISPLAY,
+VERBS = [ABOUT, APPEND, CLONE, COMPACT, CREATE, CREATE_FROM, COMPLETE_FROM, DISPLAY,
          HELP, IMPORT, LABEL, FAN, OUTPUT, OUTPUT_STOP, PATCH, QUERY,
-         REMOVE, SET, UNPATCH, WRITE, WRITE_TO, WRITE_EXIT, EXIT, RELOAD_CONFIG]
+         REMOVE, SET, UNPATCH, WRITE, WRITE_TO, WRITE_EXIT, EXIT, RELOAD_CONFIG,
+         UNDO, REDO]
 
 KWS = NOUNS + VERBS
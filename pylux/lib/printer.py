@@ -5,26 +5,22 @@ UNLABELLED_STR = '[Unlabelled]'
 
 
 def get_pretty_level_string(level, doc=None, show_labels=False, raw_data=False, function=None):
-    """From a level, which could be any decimal, hexadecimal or palette, return
-    something which looks a bit nicer."""
-    if len(level) < 2:
-        return level
-    if level[0:2] in document.PALETTE_PREFIXES:
-        palette_type = document.PALETTE_PREFIXES[level[0:2]]
-        palette = doc.get_by_ref(palette_type, level[2:])
-        if raw_data and function:
-            display_str = palette.get_function_level(function)
-            if not display_str:
-                display_str = level
-        elif show_labels and palette.label:
+    """From a FunctionLevel, whose value could be any decimal, hexadecimal or
+    palette, return something which looks a bit nicer."""
+    if level.palette_type:
+        palette = doc.resolve_palette(level)
+        display_str = str(level.value)
+        if palette and raw_data and function:
+            raw_str = palette.get_function_level(function)
+            if raw_str:
+                display_str = raw_str
+        elif palette and show_labels and palette.label:
             display_str = palette.label
-        else:
-            display_str = level
-        return palette_type.file_node_str, display_str
-    if level[0] == 'H':
-        return str(int(level.split('H')[1], 16))
+        return level.palette_type.file_node_str, display_str
+    if level.hex:
+        return str(level.raw)
     else:
-        return level
+        return str(level.value)
 
 
 def get_generic_ref(obj):
@@ -0,0 +1,304 @@
+# snapshot.py is part of Pylux
+#
+# Pylux is a program for the management of lighting documentation
+# Copyright 2015 Jack Page
+# Pylux is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pylux is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Binary snapshots of documents, which load much faster than JSON.
+
+A snapshot is written alongside a JSON document and records the size and
+modification time of the JSON file it was made from, so it is only used
+while the JSON file is unchanged. After the header, a snapshot contains a
+table of every distinct string in the document, followed by a single array
+of integers describing the objects, in which strings are given by their
+position in the table. Levels are stored already parsed, so they do not
+need to be parsed again as they are loaded.
+
+Each object in the integer array is made up of:
+    type, uuid, ref, label
+    number of tags, then key and value of each tag
+    number of levels, then function, value, kind and raw value or palette
+        ref of each
+    number of functions, then uuid, parameter, number of offsets and the
+        offsets of each
+    number of patch entries, then function, number of addresses and the
+        addresses of each
+    number of group fixtures, then the uuid of each
+Labels, tag values and level values are stored as string number * 2, plus
+1 if the string is the JSON encoding of a value which is not itself a
+string. Cue levels are only stored as their function and value, with the
+kind and parsed value left as 0."""
+
+from array import array
+from decimal import Decimal
+import json
+import os
+import struct
+import sys
+from pylux import document
+
+
+MAGIC = b'PLXS'
+VERSION = 2
+HEADER = struct.Struct('<4sHQq')
+
+# Kinds of level stored in a snapshot
+LEVEL_OTHER = 0
+LEVEL_RAW = 1
+LEVEL_HEX = 2
+LEVEL_PALETTE = 3
+
+# The errors raised by reading a damaged snapshot
+SNAPSHOT_ERRORS = (ValueError, EOFError, struct.error, KeyError, IndexError)
+# The errors raised by writing a snapshot of a document it cannot hold, or
+# to a path it cannot be written to
+WRITE_ERRORS = (OSError, ValueError, TypeError, OverflowError, struct.error)
+
+INT_MIN = -2 ** 31
+INT_MAX = 2 ** 31 - 1
+
+
+def _source_stamp(source_path):
+    stat = os.stat(source_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def is_current(path, source_path):
+    """Check whether the snapshot at path was made from the file at
+    source_path as it is now."""
+    try:
+        with open(path, 'rb') as f:
+            magic, version, size, mtime_ns = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return False
+    return magic == MAGIC and version == VERSION and (size, mtime_ns) == _source_stamp(source_path)
+
+
+def _write_array(f, arr):
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    f.write(struct.pack('<I', len(arr)))
+    arr.tofile(f)
+
+
+def _read_array(f, typecode):
+    arr = array(typecode)
+    n = struct.unpack('<I', f.read(4))[0]
+    arr.fromfile(f, n)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def write_snapshot(doc: 'document.Document', path, source_path):
+    """Write a snapshot of a document, which was last written in full to
+    source_path."""
+    strings = {}
+    ints = array('i')
+
+    def sid(s):
+        if s is None:
+            return -1
+        n = strings.get(s)
+        if n is None:
+            n = strings[s] = len(strings)
+        return n
+
+    def value_id(v):
+        if type(v) == str:
+            return sid(v) * 2
+        return sid(json.dumps(v)) * 2 + 1
+
+    for obj in doc._content.values():
+        json_object = obj.json()
+        ints.extend((sid(obj.file_node_str), sid(obj.uuid), sid(str(obj.ref)), value_id(obj.label)))
+        tags = [(k, v) for k, v in json_object.items() if k not in ['type', 'uuid', 'ref', 'label', 'levels',
+                                                                    'personality', 'entries', 'fixtures']]
+        ints.append(len(tags))
+        for k, v in tags:
+            ints.extend((sid(k), value_id(v)))
+        levels = getattr(obj, 'levels', [])
+        ints.append(len(levels))
+        if isinstance(obj, document.Cue):
+            # Cue levels are read back as values only, so are written
+            # without creating the levels themselves
+            for function_uuid, value in levels.items():
+                ints.extend((sid(function_uuid), value_id(value), LEVEL_OTHER, 0))
+            levels = []
+        for level in levels:
+            if level.raw is not None and INT_MIN <= level.raw <= INT_MAX:
+                kind = LEVEL_HEX if level.hex else LEVEL_RAW
+                parsed = level.raw
+            elif level.palette_type:
+                kind = LEVEL_PALETTE
+                parsed = sid(str(level.palette_ref))
+            else:
+                kind = LEVEL_OTHER
+                parsed = 0
+            ints.extend((sid(level.function), value_id(level.value), kind, parsed))
+        functions = getattr(obj, 'functions', [])
+        ints.append(len(functions))
+        for func in functions:
+            offset = func.offset or []
+            ints.extend((sid(func.uuid), sid(func.parameter), len(offset)))
+            ints.extend(offset)
+        entries = obj.entries if isinstance(obj, document.Registry) else []
+        ints.append(len(entries))
+        for pe in entries:
+            ints.extend((sid(pe.function), len(pe.addresses)))
+            ints.extend(pe.addresses)
+        fixtures = obj.fixtures if isinstance(obj, document.Group) else []
+        ints.append(len(fixtures))
+        for fix in fixtures:
+            ints.append(sid(fix.uuid))
+    metadata_sid = sid(json.dumps(doc.metadata))
+
+    string_list = list(strings)
+    lengths = array('I', [len(s) for s in string_list])
+    blob = ''.join(string_list).encode('utf-8')
+    size, mtime_ns = _source_stamp(source_path)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, size, mtime_ns))
+            f.write(struct.pack('<iQ', metadata_sid, len(blob)))
+            f.write(blob)
+            _write_array(f, lengths)
+            _write_array(f, ints)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def read_snapshot(path):
+    """Read a snapshot, returning an iterator of the objects in it and the
+    document metadata. Group fixtures are given as uuids, as they are in
+    JSON documents. A snapshot which is damaged may raise any of
+    SNAPSHOT_ERRORS, either here or as the objects are iterated over."""
+    with open(path, 'rb') as f:
+        magic, version, size, mtime_ns = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a version {0} snapshot: {1}'.format(VERSION, path))
+        metadata_sid, blob_size = struct.unpack('<iQ', f.read(12))
+        blob = f.read(blob_size).decode('utf-8')
+        lengths = _read_array(f, 'I')
+        ints = _read_array(f, 'i')
+    strings = []
+    pos = 0
+    for length in lengths:
+        strings.append(blob[pos:pos + length])
+        pos += length
+    del blob
+    strings.append(None)
+    return _iter_objects(strings, ints), json.loads(strings[metadata_sid])
+
+
+def _value(strings, v):
+    if v & 1:
+        return json.loads(strings[v >> 1])
+    return strings[v >> 1]
+
+
+def _iter_objects(strings, ints):
+    # Levels are created as MapLevels, so the LevelMap they are given to
+    # takes them as they are rather than copying them
+    from_parsed = document.MapLevel.from_parsed
+    # Palette refs are shared between many levels, so are only converted to
+    # Decimals once each
+    palette_refs = {}
+    pos = 0
+    end = len(ints)
+    while pos < end:
+        obj_type = document.FILE_NODE_STR_MAP[strings[ints[pos]]]
+        kwargs = {'uuid': strings[ints[pos + 1]], 'ref': Decimal(strings[ints[pos + 2]]),
+                  'label': _value(strings, ints[pos + 3])}
+        n = ints[pos + 4]
+        pos += 5
+        data = {}
+        for k, v in zip(ints[pos:pos + 2 * n:2], ints[pos + 1:pos + 2 * n:2]):
+            k = strings[k]
+            v = _value(strings, v)
+            if k in obj_type.required_attributes:
+                kwargs[k] = v
+            else:
+                data[k] = v
+        pos += 2 * n
+        n = ints[pos]
+        pos += 1
+        cue_levels = None
+        if n and obj_type is document.Cue:
+            # Cues keep their levels packed, so only need the strings
+            block = ints[pos:pos + 4 * n]
+            cue_levels = {strings[function]: strings[value >> 1] if not value & 1 else _value(strings, value)
+                          for function, value in zip(block[0::4], block[1::4])}
+            pos += 4 * n
+        elif n:
+            levels = []
+            block = ints[pos:pos + 4 * n]
+            for function, value, kind, parsed in zip(block[0::4], block[1::4], block[2::4], block[3::4]):
+                function = strings[function]
+                value = _value(strings, value)
+                if kind == LEVEL_RAW:
+                    levels.append(from_parsed(function, value, parsed))
+                elif kind == LEVEL_HEX:
+                    levels.append(from_parsed(function, value, parsed, True))
+                elif kind == LEVEL_PALETTE:
+                    if parsed not in palette_refs:
+                        palette_refs[parsed] = Decimal(strings[parsed])
+                    levels.append(from_parsed(function, value, palette_type=document.PALETTE_PREFIXES[value[0:2]],
+                                              palette_ref=palette_refs[parsed]))
+                else:
+                    levels.append(document.MapLevel(function, value))
+            pos += 4 * n
+            kwargs['levels'] = levels
+        n = ints[pos]
+        pos += 1
+        if n:
+            functions = []
+            for i in range(n):
+                uuid, parameter, n_offsets = strings[ints[pos]], strings[ints[pos + 1]], ints[pos + 2]
+                pos += 3
+                offset = ints[pos:pos + n_offsets].tolist() or None
+                pos += n_offsets
+                functions.append(document.FixtureFunction(parameter, offset, uuid))
+            kwargs['functions'] = functions
+        n = ints[pos]
+        pos += 1
+        if n:
+            entries = []
+            for i in range(n):
+                function, n_addresses = strings[ints[pos]], ints[pos + 1]
+                pos += 2
+                entries.append(document.PatchEntry(function, ints[pos:pos + n_addresses].tolist()))
+                pos += n_addresses
+            kwargs['entries'] = entries
+        n = ints[pos]
+        pos += 1
+        if n:
+            kwargs['fixtures'] = [strings[i] for i in ints[pos:pos + n]]
+            pos += n
+        obj = obj_type(**kwargs)
+        # Data is added after the object is created, as some types fill in
+        # data of their own as they are created
+        if data:
+            obj.data.update(data)
+        if cue_levels:
+            obj.merge_levels(cue_levels)
+        yield obj
@@ -504,6 +504,8 @@ class PersonalityChannel:
 
 class PersonalitySlot:
 
+    __slots__ = ('dmx_range', 'user_range', 'home', 'label', 'slot_dcid')
+
     def __init__(self, min_dmx: int = None, max_dmx: int = None, home: int = None,
                  min_user: float = None, max_user: float = None, label: str = None,
                  slot_dcid: str = None):
@@ -613,6 +615,8 @@ class CueTiming:
 
 class ChanLevel:
 
+    __slots__ = ('chan_id', 'level', 'chan')
+
     def __init__(self, chan_ref: int, level):
         self.chan_id = chan_ref
         self.level = level
@@ -620,11 +624,13 @@ class ChanLevel:
 
 
 class ChanMove(ChanLevel):
-    pass
+    __slots__ = ()
 
 
 class CueParam:
 
+    __slots__ = ('chan_id', 'param_id', 'level', 'chan', 'param')
+
     def __init__(self, chan_ref, param_ref, level):
         self.chan_id = chan_ref
         self.param_id = param_ref
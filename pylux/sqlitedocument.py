@@ -0,0 +1,446 @@
+# sqlitedocument.py is part of Pylux
+#
+# Pylux is a program for the management of lighting documentation
+# Copyright 2015 Jack Page
+# Pylux is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pylux is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A Document stored in a SQLite database rather than a JSON file.
+
+Objects are only created from the database as they are needed, and queries
+by type, ref and data tag are answered by the database, so large documents
+do not need to be loaded into memory to be searched. Objects which have
+been created are kept in an identity map, so each object in the database
+is only ever represented by one Python object. Changes are written to the
+database as objects are modified, and made permanent by write_file."""
+
+from decimal import Decimal
+import json
+import os
+import sqlite3
+from pylux import document
+
+
+# File extensions which are opened as SQLite documents
+FILE_EXTENSIONS = ['.sqlite', '.db']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    uuid TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    ref TEXT,
+    ref_value REAL,
+    label TEXT,
+    json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_type_ref ON objects (type, ref_value);
+CREATE INDEX IF NOT EXISTS objects_type_seq ON objects (type, seq);
+CREATE TABLE IF NOT EXISTS tags (
+    uuid TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+CREATE INDEX IF NOT EXISTS tags_uuid ON tags (uuid);
+CREATE TABLE IF NOT EXISTS functions (
+    uuid TEXT PRIMARY KEY,
+    fixture TEXT NOT NULL,
+    parameter TEXT,
+    offset TEXT
+);
+CREATE INDEX IF NOT EXISTS functions_fixture ON functions (fixture);
+CREATE TABLE IF NOT EXISTS levels (
+    owner TEXT NOT NULL,
+    function TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS levels_owner ON levels (owner);
+CREATE INDEX IF NOT EXISTS levels_function ON levels (function);
+CREATE TABLE IF NOT EXISTS patch (
+    registry TEXT NOT NULL,
+    function TEXT NOT NULL,
+    address INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS patch_registry ON patch (registry);
+CREATE INDEX IF NOT EXISTS patch_function ON patch (function);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# Keys of the JSON form of an object which are not stored as tags, either
+# because they have columns of their own or tables of their own
+UNTAGGED_KEYS = ['type', 'uuid', 'ref', 'levels', 'personality', 'entries', 'fixtures']
+
+
+def is_sqlite_path(path):
+    """Check whether a path should be opened as a SQLite document."""
+    return os.path.splitext(path)[1] in FILE_EXTENSIONS
+
+
+class SqliteDocument(document.Document):
+
+    def __init__(self, db_path, load_path=None):
+        """Open the SQLite document at db_path, creating it if it does not
+        exist. If load_path is given, the JSON document there is imported
+        into it."""
+        self.db_path = os.path.abspath(db_path)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.executescript(SCHEMA)
+        # The position of each object created from the database in the
+        # document, so that it keeps its place when written back
+        self._seq = {}
+        self._next_seq = self._db.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM objects').fetchone()[0]
+        super().__init__()
+        self.metadata = document.DataDict(
+            self, {k: json.loads(v) for k, v in self._db.execute('SELECT key, value FROM metadata')})
+        if load_path:
+            self.load_file(load_path)
+
+    def close(self):
+        """Close the database, discarding any changes which have not been
+        written."""
+        self._db.close()
+
+    def _materialise(self, uuid, json_str):
+        """Get the object for a row of the objects table, creating it if it
+        has not been created already."""
+        obj = self._uuid_index.get(uuid)
+        if obj:
+            return obj
+        json_object = json.loads(json_str)
+        obj_type = document.FILE_NODE_STR_MAP[json_object.pop('type')]
+        obj = obj_type(json_object=json_object)
+        # Index the object first, in case anything it refers to refers
+        # back to it
+        obj._document = self
+        self._uuid_index[uuid] = obj
+        self._resolve_object(obj, self.get_by_uuid)
+        return obj
+
+    def _query_objects(self, sql, params=()):
+        """Get a list of objects from a query giving uuid and json columns."""
+        self._flush()
+        return [self._materialise(uuid, json_str) for uuid, json_str in self._db.execute(sql, params)]
+
+    def _store(self, json_object, seq):
+        """Write the JSON form of an object to the database."""
+        uuid = json_object['uuid']
+        ref = json_object.get('ref')
+        self._db.execute('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)', (
+            uuid, seq, json_object['type'], ref, float(Decimal(ref)) if ref is not None else None,
+            json_object.get('label'), json.dumps(json_object)))
+        self._db.executemany('INSERT INTO tags VALUES (?, ?, ?)', [
+            (uuid, k, json.dumps(v)) for k, v in json_object.items() if k not in UNTAGGED_KEYS])
+        self._db.executemany('INSERT INTO functions VALUES (?, ?, ?, ?)', [
+            (func['uuid'], uuid, func.get('param'), func.get('offset'))
+            for func in json_object.get('personality', [])])
+        self._db.executemany('INSERT INTO levels VALUES (?, ?, ?)', [
+            (uuid, function, value) for function, value in json_object.get('levels', {}).items()])
+        self._db.executemany('INSERT INTO patch VALUES (?, ?, ?)', [
+            (uuid, function, int(addr)) for function, addrs in json_object.get('entries', {}).items()
+            for addr in addrs])
+
+    def _delete(self, uuid):
+        """Remove all rows belonging to an object from the database."""
+        self._db.execute('DELETE FROM objects WHERE uuid = ?', (uuid,))
+        self._db.execute('DELETE FROM tags WHERE uuid = ?', (uuid,))
+        self._db.execute('DELETE FROM functions WHERE fixture = ?', (uuid,))
+        self._db.execute('DELETE FROM levels WHERE owner = ?', (uuid,))
+        self._db.execute('DELETE FROM patch WHERE registry = ?', (uuid,))
+
+    def _flush(self):
+        """Write changed objects to the database, so that queries see them.
+        The changes are not permanent until they are committed."""
+        if not self._changes and not self._metadata_changed:
+            return
+        for uuid, obj in self._changes.items():
+            seq = self._seq_of(uuid)
+            self._delete(uuid)
+            if obj is not None:
+                self._store(obj.json(), seq)
+        if self._metadata_changed:
+            self._db.execute('DELETE FROM metadata')
+            self._db.executemany('INSERT INTO metadata VALUES (?, ?)', [
+                (k, json.dumps(v)) for k, v in self.metadata.items()])
+        self._changes = {}
+        self._metadata_changed = False
+
+    def _seq_of(self, uuid):
+        """Get the position of an object in the document."""
+        if uuid not in self._seq:
+            row = self._db.execute('SELECT seq FROM objects WHERE uuid = ?', (uuid,)).fetchone()
+            if row:
+                self._seq[uuid] = row[0]
+            else:
+                self._seq[uuid] = self._next_seq
+                self._next_seq += 1
+        return self._seq[uuid]
+
+    def load_file(self, path, streaming=True):
+        """Import a JSON document into the database, adding its objects after
+        any already in the database. Changes saved to the journal of the
+        document are applied as they are by Document.load_file. The import is
+        committed once complete."""
+        self._flush()
+        journal, metadata = document._read_journal(path + document.JOURNAL_SUFFIX)
+        # Metadata saved to the journal replaces the metadata in the file
+        journal_has_metadata = metadata is not None
+
+        def import_object(obj):
+            nonlocal metadata
+            if obj.get('type') in document.FILE_NODE_STR_MAP:
+                self._delete(obj['uuid'])
+                self._uuid_index.pop(obj['uuid'], None)
+                self._store(obj, self._seq_of(obj['uuid']))
+            elif obj.get('type') == 'metadata' and not journal_has_metadata:
+                metadata = obj['tags']
+
+        with open(path, 'r') as f:
+            if streaming:
+                raw = document._iter_json_list(f)
+            else:
+                raw = json.loads(f.read())
+            for obj in raw:
+                # Objects which have changed since the file was written are
+                # taken from the journal instead, keeping their position
+                if obj.get('uuid') in journal:
+                    uuid = obj['uuid']
+                    obj = journal.pop(uuid)
+                    if obj is None:
+                        self._delete(uuid)
+                        self._uuid_index.pop(uuid, None)
+                        continue
+                import_object(obj)
+        # Anything left in the journal was created since the file was written
+        for obj in journal.values():
+            if obj is not None:
+                import_object(obj)
+        if metadata is not None:
+            self.metadata.update(metadata)
+        self._cue_trackers = {}
+        self._palette_token = object()
+        self.write_file(self.db_path)
+        # Objects were written straight to the database, so anything may
+        # have changed
+        self._change_log = []
+        self._log_start = self.version = self.version + 1
+        self._undo_stack = []
+        self._redo_stack = []
+        self._notify()
+
+    def write_file(self, path):
+        """Commit all changes to the database. If path is anything other than
+        the database itself, the document is also exported to it as JSON,
+        in the same way as a JSON document is written. Another database
+        can't be written to, as it would be given JSON."""
+        self._flush()
+        self._db.commit()
+        path = os.path.abspath(path)
+        if path == self.db_path:
+            return
+        if is_sqlite_path(path):
+            raise ValueError('Can only export to a JSON file, not to ' + path)
+
+        def write(f):
+            f.write('[')
+            for (json_str,) in self._db.execute('SELECT json FROM objects ORDER BY seq'):
+                f.write(json_str)
+                f.write(', ')
+            json.dump({'type': 'metadata', 'tags': self.metadata}, f)
+            f.write(']')
+
+        document._write_atomic(path, write)
+
+    def write_journal(self, path):
+        """Changes are always written straight to the database, so there is
+        no journal to keep."""
+        self.write_file(path)
+
+    def insert_object(self, obj):
+        """Add an object to the document."""
+        obj._document = self
+        self._uuid_index[obj.uuid] = obj
+        self._changes[obj.uuid] = obj
+        self._index_changed(obj)
+        self._record_change(obj.uuid, document.CHANGE_INSERT)
+        self._record_undo(self.remove_object, obj)
+
+    def remove_object(self, obj):
+        """Remove an object from the document. Fixtures are also removed
+        from every group they are in."""
+        with self.operation():
+            if isinstance(obj, document.Fixture):
+                for group in self.get_fixture_groups(obj):
+                    group.remove_fixture(obj)
+            obj._document = None
+            self._uuid_index.pop(obj.uuid, None)
+            self._changes[obj.uuid] = None
+            self._index_changed(obj)
+            self._record_change(obj.uuid, document.CHANGE_REMOVE)
+            self._record_undo(self.insert_object, obj)
+
+    def _index_changed(self, obj):
+        """Discard cached state which depends on the set of objects."""
+        if isinstance(obj, document.Palette):
+            self._palette_token = object()
+        if isinstance(obj, document.Cue):
+            self._cue_trackers = {}
+
+    def _index_patch(self, reg, pe):
+        self._object_changed(reg)
+
+    def _unindex_patch(self, reg, pe):
+        self._object_changed(reg)
+
+    def _ref_changed(self, obj, old_key):
+        # The ref column is rewritten along with the rest of the object
+        self._object_changed(obj)
+        self._index_changed(obj)
+
+    def _group_fixture_changed(self, group, uuid, added):
+        # Groups are searched in the database instead of being indexed
+        pass
+
+    def _cue_levels_changed(self, cue):
+        # Trackers are rebuilt from the database, so cannot be partially
+        # invalidated without flushing every change first
+        self._cue_trackers = {}
+
+    def get_by_type(self, obj_type):
+        """Get an iterator of all objects of a given type."""
+        yield from self._query_objects(
+            'SELECT uuid, json FROM objects WHERE type = ? ORDER BY seq', (obj_type.file_node_str,))
+
+    def get_by_ref(self, obj_type, ref: Decimal):
+        """Get the object of a given type with a given reference."""
+        for obj in self.get_by_ref_range(obj_type, ref, ref):
+            return obj
+
+    def get_by_ref_range(self, obj_type, r_min: Decimal = None, r_max: Decimal = None):
+        """Get a list of all objects of a given type with references between
+        r_min and r_max inclusive, in reference order."""
+        sql = 'SELECT uuid, json FROM objects WHERE type = ?'
+        params = [obj_type.file_node_str]
+        # The database compares floats, so check the ref keys afterwards
+        if r_min is not None:
+            r_min = document.to_ref_key(r_min)
+            sql += ' AND ref_value >= ?'
+            params.append(r_min / document.REF_SCALE - 0.0005)
+        if r_max is not None:
+            r_max = document.to_ref_key(r_max)
+            sql += ' AND ref_value <= ?'
+            params.append(r_max / document.REF_SCALE + 0.0005)
+        sql += ' ORDER BY ref_value, seq'
+        return [obj for obj in self._query_objects(sql, params)
+                if (r_min is None or obj.ref_key >= r_min) and (r_max is None or obj.ref_key <= r_max)]
+
+    def next_ref(self, obj_type):
+        """Get the next available whole-number reference for an object type."""
+        self._flush()
+        file_node_str = obj_type.file_node_str
+        if not self._db.execute('SELECT 1 FROM objects WHERE type = ? AND ref_value = 1',
+                                (file_node_str,)).fetchone():
+            return Decimal(1)
+        # The first whole-number ref whose successor is not in use
+        row = self._db.execute(
+            'SELECT MIN(a.ref_value) FROM objects a WHERE a.type = ? AND a.ref_value >= 1 '
+            'AND a.ref_value = CAST(a.ref_value AS INTEGER) AND NOT EXISTS '
+            '(SELECT 1 FROM objects b WHERE b.type = a.type AND b.ref_value = a.ref_value + 1)',
+            (file_node_str,)).fetchone()
+        return Decimal(int(row[0]) + 1)
+
+    def get_by_uuid(self, uuid):
+        """Get the object with the given unique identifier."""
+        if uuid in self._uuid_index:
+            return self._uuid_index[uuid]
+        if uuid in self._changes:
+            return None
+        for obj in self._query_objects('SELECT uuid, json FROM objects WHERE uuid = ?', (uuid,)):
+            return obj
+
+    def get_function_by_uuid(self, uuid: str):
+        """Get a function object given its unique identifier."""
+        self._flush()
+        row = self._db.execute('SELECT fixture FROM functions WHERE uuid = ?', (uuid,)).fetchone()
+        if row:
+            for func in self.get_by_uuid(row[0]).functions:
+                if func.uuid == uuid:
+                    return func
+
+    def get_function_parent(self, func: 'document.FixtureFunction'):
+        """Get the fixture that a function belongs to."""
+        self._flush()
+        row = self._db.execute('SELECT fixture FROM functions WHERE uuid = ?', (func.uuid,)).fetchone()
+        if row:
+            return self.get_by_uuid(row[0])
+
+    def add_function(self, fixture: 'document.Fixture', func: 'document.FixtureFunction'):
+        """Append a function to the personality of a fixture."""
+        fixture.functions.append(func)
+        self._object_changed(fixture)
+        self._record_undo(self._remove_function, fixture, func)
+
+    def get_function_patch(self, func: 'document.FixtureFunction'):
+        """Get the registry and address number of a functions patch."""
+        self._flush()
+        row = self._db.execute('SELECT registry FROM patch WHERE function = ?', (func.uuid,)).fetchone()
+        if row:
+            reg = self.get_by_uuid(row[0])
+            return reg, reg._function_entries[func.uuid].addresses
+
+    def unpatch_fixture_from_all(self, fixture: 'document.Fixture'):
+        """Unpatch a fixture from all registries."""
+        for func in fixture.functions:
+            patch = self.get_function_patch(func)
+            if patch:
+                patch[0].unpatch_function(func)
+
+    def get_fixture_groups(self, fixture: 'document.Fixture'):
+        """Get a list of the groups a fixture is in."""
+        return [group for group in self.get_by_type(document.Group) if fixture in group.fixtures]
+
+    def get_by_tag(self, obj_type, key, value):
+        """Get the objects of a type whose value for a key, as given by
+        their get method, is the same as value once both are converted to
+        strings, as a dict keyed by uuid. The tags table holds values as
+        JSON, so it is searched for every JSON value which could give that
+        string, and the objects found are then compared as strings."""
+        value = str(value)
+        if key in UNTAGGED_KEYS or value == 'None':
+            # Objects without the key would match, and they have no tag
+            return {obj.uuid: obj for obj in self.get_by_type(obj_type) if str(obj.get(key)) == value}
+        candidates = [json.dumps(value), value]
+        if value in ('True', 'False'):
+            candidates.append(value.lower())
+        sql = ('SELECT uuid, json FROM objects WHERE type = ? AND uuid IN '
+               '(SELECT uuid FROM tags WHERE key = ? AND value IN ({})) ORDER BY seq').format(
+            ', '.join('?' * len(candidates)))
+        return {obj.uuid: obj for obj in self._query_objects(sql, [obj_type.file_node_str, key] + candidates)
+                if str(obj.get(key)) == value}
+
+    def filter_type_by_params(self, obj_type, params):
+        """Get all objects which satisfy the parameters given by key/value
+        pairs in params. Parameters with string or integer values are
+        matched by the database, and the rest are checked afterwards."""
+        sql = 'SELECT uuid, json FROM objects WHERE type = ?'
+        sql_params = [obj_type.file_node_str]
+        for k, v in params:
+            if type(v) in (str, int):
+                sql += ' AND uuid IN (SELECT uuid FROM tags WHERE key = ? AND value = ?)'
+                sql_params += [k, json.dumps(v)]
+        sql += ' ORDER BY seq'
+        return [obj for obj in self._query_objects(sql, sql_params)
+                if all(obj.get(k) == v for k, v in params)]